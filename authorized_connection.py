@@ -0,0 +1,183 @@
+import asyncio
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+import json
+import logging
+import time
+from typing import Any, AsyncIterator
+
+logger = logging.getLogger(__name__)
+
+# host, port and token
+ConnectionKey = tuple[str, int, str]
+
+
+class InvalidTokenError(Exception):
+    pass
+
+
+@dataclass
+class AuthorizedConnection:
+    key: ConnectionKey
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    creds: dict[str, Any]
+    last_used: float = field(default_factory=time.monotonic)
+
+    def is_healthy(self) -> bool:
+        return (not self.writer.is_closing()
+                and not self.reader.at_eof()
+                and self.reader.exception() is None)
+
+
+async def open_authorized_connection(host: str, port: int,
+                                     token: str) -> AuthorizedConnection:
+    """Open connection and authorize it by token, raise InvalidTokenError for wrong one"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        greeting_msg = await reader.readline()
+        logger.debug('RECEIVE: %s', greeting_msg.decode().strip())
+
+        writer.write(f'{token}\n'.encode())
+        await writer.drain()
+
+        credentials_msg = await reader.readline()
+        logger.debug('RECEIVE: %s', credentials_msg.decode().strip())
+
+        creds = json.loads(credentials_msg.decode().strip())
+        if not creds:
+            raise InvalidTokenError(token)
+
+        # welcome is sent after credentials, it isn't a reply on any message
+        welcome_msg = await reader.readline()
+        logger.debug('RECEIVE: %s', welcome_msg.decode().strip())
+    except BaseException:
+        writer.close()
+        raise
+
+    return AuthorizedConnection((host, port, token), reader, writer, creds)
+
+
+class ConnectionPool:
+    """
+    Pool of authorized connections to chat by (host, port, token).
+
+    Pool holds at most max_size connections, idle connections are closed after
+    idle_timeout seconds. If pool is full, least recently used idle connection is closed,
+    if there are no idle connections, checkout waits for releasing of any connection.
+    Connection is checked before checkout, broken connections are replaced with new ones
+    """
+
+    def __init__(self, max_size: int = 100, idle_timeout: float = 60.0):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+
+        self._idle = defaultdict(list)
+        self._size = 0
+        self._released = asyncio.Condition()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def idle_count(self) -> int:
+        return sum(len(connections) for connections in self._idle.values())
+
+    @asynccontextmanager
+    async def session(self, host: str, port: int,
+                      token: str) -> AsyncIterator[AuthorizedConnection]:
+        """
+        Check out authorized connection and return it in pool after the body.
+
+        Connection is closed if body raises exception, so it isn't reused
+        with unread replies or in unknown state
+        """
+        connection = await self._acquire((host, port, token))
+        try:
+            yield connection
+        except BaseException:
+            self._close(connection)
+            await self._notify_released()
+            raise
+
+        connection.last_used = time.monotonic()
+        self._idle[connection.key].append(connection)
+        await self._notify_released()
+
+    def evict_idle(self) -> int:
+        """Close connections idle longer than idle_timeout, return count of them"""
+        deadline = time.monotonic() - self.idle_timeout
+        evicted_count = 0
+        for key, connections in list(self._idle.items()):
+            alive = []
+            for connection in connections:
+                if connection.last_used < deadline or not connection.is_healthy():
+                    self._close(connection)
+                    evicted_count += 1
+                else:
+                    alive.append(connection)
+            self._idle[key] = alive
+        return evicted_count
+
+    async def run_eviction(self) -> None:
+        """Evict idle connections in background"""
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2)
+            if self.evict_idle():
+                await self._notify_released()
+
+    async def close(self) -> None:
+        connections = [connection for idle in self._idle.values() for connection in idle]
+        self._idle.clear()
+        for connection in connections:
+            self._close(connection)
+        for connection in connections:
+            try:
+                await connection.writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _acquire(self, key: ConnectionKey) -> AuthorizedConnection:
+        while True:
+            self.evict_idle()
+            idle = self._idle.get(key)
+            while idle:
+                connection = idle.pop()
+                if connection.is_healthy():
+                    return connection
+                self._close(connection)
+
+            if self._size < self.max_size or self._evict_least_recently_used():
+                break
+
+            async with self._released:
+                await self._released.wait()
+
+        self._size += 1
+        try:
+            return await open_authorized_connection(*key)
+        except BaseException:
+            self._size -= 1
+            await self._notify_released()
+            raise
+
+    def _evict_least_recently_used(self) -> bool:
+        idle = [connection for connections in self._idle.values()
+                for connection in connections]
+        if not idle:
+            return False
+
+        connection = min(idle, key=lambda connection: connection.last_used)
+        self._idle[connection.key].remove(connection)
+        self._close(connection)
+        return True
+
+    def _close(self, connection: AuthorizedConnection) -> None:
+        self._size -= 1
+        connection.writer.close()
+
+    async def _notify_released(self) -> None:
+        async with self._released:
+            self._released.notify()
@@ -0,0 +1,396 @@
+import argparse
+import asyncio
+from dataclasses import dataclass
+import json
+import logging
+from pathlib import Path
+import statistics
+import sys
+import tempfile
+import time
+import tkinter as tk
+from typing import Optional
+
+import anyio
+
+from authorized_connection import open_authorized_connection
+from capture import CaptureWriter, ReplayServer, capture_digest
+import chat_listener
+import chat_writer
+from fake_server import FakeChat, get_port, start_listen_server, start_write_server
+from messenger import Messenger
+from queues import BoundedQueue, OverflowPolicy
+
+HOST = '127.0.0.1'
+BENCHMARKS = ('auth', 'send', 'listen', 'reconnect', 'replay', 'startup')
+
+
+@dataclass
+class Options:
+    benchmarks: list[str]
+    lines_count: int
+    messages_count: int
+    clients: int
+    rate: float
+    reconnects: int
+    capture_path: Optional[Path]
+    speed: float
+    save_baseline: Optional[Path]
+    compare: Optional[Path]
+    tolerance: float
+
+
+class LostLinesError(Exception):
+    pass
+
+
+def format_latencies(latencies: list[float]) -> str:
+    latencies = sorted(latencies)
+    p95 = latencies[-1]
+    if len(latencies) >= 20:
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+    return (f'median {statistics.median(latencies) * 1000:.2f} ms, '
+            f'p95 {p95 * 1000:.2f} ms, max {latencies[-1] * 1000:.2f} ms')
+
+
+def count_lines(path: Path) -> int:
+    with open(path, 'rb') as f:
+        return sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1 << 20), b''))
+
+
+def check_saved_lines(history_path: Path, lines_count: int) -> None:
+    """Raise LostLinesError if history file doesn't have every received line"""
+    saved_count = count_lines(history_path)
+    if saved_count != lines_count:
+        raise LostLinesError(
+            f'{saved_count} of {lines_count} lines are saved in {history_path.name}')
+
+
+def write_synthetic_capture(path: Path, lines_count: int, rate: float = 0) -> None:
+    """Capture of generated lines of fake chat, rate is lines per second, 0 is no pause"""
+    with CaptureWriter(path) as capture:
+        for start in range(0, lines_count, 1000):
+            received_at = start / rate if rate else 0.0
+            chunk = FakeChat.generate_messages(start, min(1000, lines_count - start))
+            capture.write(chunk, received_at)
+
+
+async def bench_auth(clients: int) -> list[float]:
+    """Return latencies of connection and authorization of concurrent clients"""
+    chat = FakeChat()
+    server = await start_write_server(HOST, 0, chat)
+    tokens = [chat.register(f'bot{number}')['account_hash'] for number in range(clients)]
+
+    async def connect(token: str) -> float:
+        started_at = time.perf_counter()
+        connection = await open_authorized_connection(HOST, get_port(server), token)
+        latency = time.perf_counter() - started_at
+        connection.writer.close()
+        return latency
+
+    latencies = await asyncio.gather(*(connect(token) for token in tokens))
+    server.close()
+    await server.wait_closed()
+    return latencies
+
+
+async def bench_send(messages_count: int, clients: int) -> float:
+    """Return messages per second which chat receives from concurrent writers"""
+    chat = FakeChat()
+    server = await start_write_server(HOST, 0, chat)
+    tokens = [chat.register(f'bot{number}')['account_hash'] for number in range(clients)]
+    connections = await asyncio.gather(
+        *(open_authorized_connection(HOST, get_port(server), token) for token in tokens))
+
+    messages_per_client = messages_count // clients
+    started_at = time.perf_counter()
+    await asyncio.gather(*(
+        chat_writer.submit_messages_bulk(
+            connection.reader, connection.writer,
+            (f'message number {number}' for number in range(messages_per_client)))
+        for connection in connections
+    ))
+    await chat.wait_received(messages_per_client * clients)
+    elapsed = time.perf_counter() - started_at
+
+    for connection in connections:
+        connection.writer.close()
+    server.close()
+    await server.wait_closed()
+    return messages_per_client * clients / elapsed
+
+
+async def bench_listen(lines_count: int, daemon: bool, rate: float = 0) -> float:
+    """Return lines per second which chat_listener saves in history"""
+    chat = FakeChat(rate=rate or float('inf'), count=lines_count)
+    server = await start_listen_server(HOST, 0, chat)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        history_path = Path(tmp_dir) / 'history.txt'
+        options = chat_listener.Options(
+            host=HOST, port=get_port(server), history_path=history_path, logging=False,
+            flush_size=10000, daemon=daemon, reconnect=False,
+        )
+        started_at = time.perf_counter()
+        await chat_listener.echo_chat(options)
+        elapsed = time.perf_counter() - started_at
+
+        check_saved_lines(history_path, lines_count)
+
+    server.close()
+    await server.wait_closed()
+    return lines_count / elapsed
+
+
+async def bench_replay(capture_path: Path, speed: float) -> dict[str, float]:
+    """
+    Return lines per second which listener and messenger save from replay of capture.
+
+    Names of rates have digest and lines count of capture and speed of replay,
+    so they are compared only with baseline of the same replay
+    """
+    replay_server = ReplayServer(capture_path, speed)
+    server = await replay_server.start(HOST, 0)
+    lines_count = replay_server.lines_count
+    chunks = replay_server.chunks
+    if chunks and not chunks[-1][1].endswith(b'\n'):
+        # the last line is cut by the end of capture, but it is saved too
+        lines_count += 1
+    replay = f'capture {capture_digest(capture_path)} of {lines_count} lines, ' + (
+        f'{speed:g}x speed' if speed else 'max speed')
+
+    rates = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for daemon in (False, True):
+            mode = 'daemon' if daemon else 'lines'
+            history_path = Path(tmp_dir) / f'listener-{mode}.txt'
+            options = chat_listener.Options(
+                host=HOST, port=get_port(server), history_path=history_path,
+                logging=False, flush_size=10000, daemon=daemon, reconnect=False,
+            )
+            started_at = time.perf_counter()
+            await chat_listener.echo_chat(options)
+            elapsed = time.perf_counter() - started_at
+            check_saved_lines(history_path, lines_count)
+            rates[f'replay listen {mode}, {replay}'] = lines_count / elapsed
+
+        history_path = Path(tmp_dir) / 'messenger.txt'
+        messenger = Messenger(
+            messages_queue=BoundedQueue(1000, OverflowPolicy.DROP_OLDEST),
+            sending_queue=BoundedQueue(1000),
+            status_updates_queue=BoundedQueue(100, OverflowPolicy.DROP_OLDEST),
+            listen_host=HOST, listen_port=get_port(server), history_path=history_path,
+            write_host=HOST, write_port=0, token='', flush_size=10000,
+        )
+        started_at = time.perf_counter()
+        async with anyio.create_task_group() as tg:
+            tg.start_soon(messenger.save_msgs)
+            await messenger.read_msgs()
+            # cancelled sink writes everything what is queued
+            tg.cancel_scope.cancel()
+        elapsed = time.perf_counter() - started_at
+        check_saved_lines(history_path, lines_count)
+        rates[f'replay messenger, {replay}'] = lines_count / elapsed
+
+    server.close()
+    await server.wait_closed()
+    return rates
+
+
+async def bench_reconnect(reconnects: int, rate: float) -> list[float]:
+    """Return seconds from connections drop till messenger listens chat again"""
+    chat = FakeChat(rate=rate)
+    listen_server = await start_listen_server(HOST, 0, chat)
+    write_server = await start_write_server(HOST, 0, chat)
+    token = chat.register('bot')['account_hash']
+
+    async def wait_for(predicate) -> None:
+        while not predicate():
+            await asyncio.sleep(0.001)
+
+    reconnect_times = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        messenger = Messenger(
+            messages_queue=BoundedQueue(1000, OverflowPolicy.DROP_OLDEST),
+            sending_queue=BoundedQueue(1000),
+            status_updates_queue=BoundedQueue(100, OverflowPolicy.DROP_OLDEST),
+            listen_host=HOST, listen_port=get_port(listen_server),
+            history_path=Path(tmp_dir) / 'history.txt',
+            write_host=HOST, write_port=get_port(write_server), token=token,
+        )
+        async with anyio.create_task_group() as tg:
+            tg.start_soon(messenger.handle_connection)
+            await wait_for(lambda: chat.listeners)
+
+            for _ in range(reconnects):
+                connections_count = chat.connections_count
+                started_at = time.perf_counter()
+                chat.disconnect_all()
+                await wait_for(lambda: chat.listeners
+                               and chat.connections_count > connections_count)
+                reconnect_times.append(time.perf_counter() - started_at)
+
+            tg.cancel_scope.cancel()
+
+    for server in (listen_server, write_server):
+        server.close()
+        await server.wait_closed()
+    return reconnect_times
+
+
+def bench_startup(lines_count: int, runs: int = 5) -> list[float]:
+    """
+    Return seconds till the last page of history of lines_count lines is drawn.
+
+    Messenger reads the page and seeds deduplication on init. Without display
+    the page is not drawn, so only reading of history is measured
+    """
+    try:
+        root = tk.Tk()
+    except tk.TclError:
+        root = None
+
+    startup_times = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        history_path = Path(tmp_dir) / 'history.txt'
+        with open(history_path, 'wb') as f:
+            for start in range(0, lines_count, 1000):
+                count = min(1000, lines_count - start)
+                f.write(FakeChat.generate_messages(start, count))
+
+        for _ in range(runs):
+            started_at = time.perf_counter()
+            messenger = Messenger(
+                messages_queue=asyncio.Queue(), sending_queue=BoundedQueue(1000),
+                status_updates_queue=BoundedQueue(100, OverflowPolicy.DROP_OLDEST),
+                listen_host=HOST, listen_port=0, history_path=history_path,
+                write_host=HOST, write_port=0, token='',
+            )
+            # GUI takes the last page as the first older page
+            messages = messenger.load_older_history_messages()
+            if root is not None:
+                panel = tk.Text(root)
+                panel.pack()
+                panel.insert('end', '\n'.join(messages))
+                panel.yview(tk.END)
+                root.update()
+                panel.destroy()
+            startup_times.append(time.perf_counter() - started_at)
+
+    if root is not None:
+        root.destroy()
+    return startup_times
+
+
+def compare_with_baseline(rates: dict[str, float], baseline_path: Path,
+                          tolerance: float) -> list[str]:
+    """Return regressions of rates lower than in baseline more than by tolerance share"""
+    with open(baseline_path, encoding='UTF8') as f:
+        baseline = json.load(f)
+
+    regressions = []
+    for name, rate in rates.items():
+        baseline_rate = baseline.get(name)
+        if baseline_rate is not None and rate < baseline_rate * (1 - tolerance):
+            regressions.append(f'{name}: {rate:,.0f}/sec, baseline {baseline_rate:,.0f}')
+    return regressions
+
+
+async def main(options: Options) -> dict[str, float]:
+    """
+    Run benchmarks and return throughputs by name, latencies are only printed.
+
+    Name has parameters of benchmark, so throughput is compared only with the same run
+    """
+    rates = {}
+    if 'auth' in options.benchmarks:
+        latencies = await bench_auth(options.clients)
+        print(f'connect and auth, {options.clients} clients: '
+              f'{format_latencies(latencies)}')
+
+    if 'send' in options.benchmarks:
+        name = f'send, {options.messages_count} messages, {options.clients} clients'
+        rate = rates[name] = await bench_send(options.messages_count, options.clients)
+        print(f'{name}: {rate:,.0f} messages/sec')
+
+    if 'listen' in options.benchmarks:
+        offered = f'{options.rate:g} lines/sec offered' if options.rate else 'max speed'
+        for daemon in (False, True):
+            mode = 'daemon' if daemon else 'lines'
+            name = f'listen {mode}, {options.lines_count} lines, {offered}'
+            rate = rates[name] = await bench_listen(
+                options.lines_count, daemon, options.rate)
+            print(f'{name}: {rate:,.0f} lines/sec')
+
+    if 'reconnect' in options.benchmarks:
+        reconnect_times = await bench_reconnect(options.reconnects, options.rate)
+        print(f'reconnect of messenger: {format_latencies(reconnect_times)}')
+
+    if 'replay' in options.benchmarks:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            capture_path = options.capture_path
+            if capture_path is None:
+                capture_path = Path(tmp_dir) / 'synthetic.cap'
+                write_synthetic_capture(capture_path, options.lines_count, options.rate)
+            replay_rates = await bench_replay(capture_path, options.speed)
+        for name, rate in replay_rates.items():
+            print(f'{name}: {rate:,.0f} lines/sec')
+        rates.update(replay_rates)
+
+    if 'startup' in options.benchmarks:
+        startup_times = bench_startup(options.lines_count)
+        print(f'startup of messenger, {options.lines_count} lines of history: '
+              f'{format_latencies(startup_times)}')
+
+    return rates
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Chat benchmarks',
+        description='Benchmarks of chat clients against local fake chat server',
+    )
+
+    parser.add_argument('-b', '--benchmarks', nargs='+', choices=BENCHMARKS,
+                        default=list(BENCHMARKS), help='benchmarks to run')
+    parser.add_argument('-n', '--lines_count', type=int, default=1_000_000,
+                        help='count of lines which listener receives')
+    parser.add_argument('-m', '--messages_count', type=int, default=100_000,
+                        help='count of messages which writers send')
+    parser.add_argument('-c', '--clients', type=int, default=10,
+                        help='count of concurrent writers')
+    parser.add_argument('-r', '--rate', type=float, default=0,
+                        help='messages per second in chat, '
+                             '0 is max speed for listen and silence for reconnect')
+    parser.add_argument('-rc', '--reconnects', type=int, default=5,
+                        help='count of connection drops for reconnect benchmark')
+    parser.add_argument('-cp', '--capture_path', type=Path, default=None,
+                        help='capture to replay, by default capture of '
+                             'LINES_COUNT generated lines with RATE')
+    parser.add_argument('-s', '--speed', type=float, default=0,
+                        help='speed of replay, 1 is original, 0 is as fast as possible')
+    parser.add_argument('--save_baseline', type=Path, default=None,
+                        help='save throughputs in json file to compare next runs')
+    parser.add_argument('--compare', type=Path, default=None,
+                        help='exit with error if throughput is lower than in baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='share of baseline throughput which is allowed to be lost')
+
+    args = parser.parse_args()
+
+    options = Options(**args.__dict__)
+
+    logging.disable()
+
+    rates = asyncio.run(main(options))
+
+    if options.save_baseline is not None:
+        with open(options.save_baseline, 'w', encoding='UTF8') as f:
+            json.dump(rates, f, indent=1)
+
+    if options.compare is not None:
+        regressions = compare_with_baseline(rates, options.compare, options.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
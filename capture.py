@@ -0,0 +1,200 @@
+import argparse
+import asyncio
+from dataclasses import dataclass
+import hashlib
+import logging
+from pathlib import Path
+import struct
+import time
+from typing import BinaryIO, Iterator, Optional
+
+import anyio
+
+from context_managers import open_connection
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'CHATCAP1'
+# seconds from start of capture and size of chunk, then chunk itself
+RECORD = struct.Struct('<dI')
+
+
+@dataclass
+class Options:
+    host: Optional[str]
+    port: Optional[int]
+    capture_path: Path
+    duration: Optional[float]
+    replay: bool
+    replay_host: str
+    replay_port: int
+    speed: float
+    logging: bool
+
+
+class CaptureWriter:
+    """Append chunks of inbound bytes with their receive time to capture file"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.chunks_count = 0
+        self.bytes_count = 0
+        self._file: Optional[BinaryIO] = None
+        self._started_at = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'wb')
+        self._file.write(MAGIC)
+        return self
+
+    def __exit__(self, *args):
+        self._file.close()
+
+    def write(self, chunk: bytes, received_at: Optional[float] = None) -> None:
+        """Write chunk, received_at is monotonic time, now by default"""
+        if received_at is None:
+            received_at = time.monotonic()
+        if self._started_at is None:
+            self._started_at = received_at
+        self._file.write(RECORD.pack(received_at - self._started_at, len(chunk)))
+        self._file.write(chunk)
+        self.chunks_count += 1
+        self.bytes_count += len(chunk)
+
+
+def read_capture(path: Path) -> Iterator[tuple[float, bytes]]:
+    """Chunks of capture with seconds from start of capture"""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a capture file')
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            offset, size = RECORD.unpack(header)
+            chunk = f.read(size)
+            if len(chunk) < size:
+                logger.warning('capture %s is cut in the middle of chunk', path)
+                return
+            yield offset, chunk
+
+
+def capture_digest(path: Path) -> str:
+    """Short hash of capture file, the same capture has the same digest on any machine"""
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256()
+        for data in iter(lambda: f.read(1 << 20), b''):
+            digest.update(data)
+    return digest.hexdigest()[:12]
+
+
+async def record(host: str, port: int, path: Path, duration: Optional[float] = None,
+                 chunk_size: int = 64 * 1024) -> CaptureWriter:
+    """Capture inbound bytes of chat until it closes connection or duration is elapsed"""
+    async with open_connection(host, port) as (reader, writer):
+        with CaptureWriter(path) as capture, anyio.move_on_after(duration):
+            while True:
+                # chunks are small and buffered by file, so writing doesn't block loop
+                chunk = await reader.read(chunk_size)
+                if not chunk:
+                    break
+                capture.write(chunk)
+    logger.info('%d bytes in %d chunks are captured', capture.bytes_count,
+                capture.chunks_count)
+    return capture
+
+
+class ReplayServer:
+    """
+    Send chunks of capture to every connected listener and close connection after them.
+
+    Speed 1 keeps original intervals between chunks, speed N makes them N times shorter,
+    speed 0 sends chunks as fast as listener reads them. Capture is read in memory once,
+    so every connection gets the same bytes
+    """
+
+    def __init__(self, path: Path, speed: float = 1.0):
+        self.chunks = list(read_capture(path))
+        self.speed = speed
+        self.replays_count = 0
+
+    @property
+    def lines_count(self) -> int:
+        return sum(chunk.count(b'\n') for _, chunk in self.chunks)
+
+    async def handle_listener(self, reader: asyncio.StreamReader,
+                              writer: asyncio.StreamWriter) -> None:
+        started_at = time.monotonic()
+        try:
+            for offset, chunk in self.chunks:
+                if self.speed:
+                    delay = started_at + offset / self.speed - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                writer.write(chunk)
+                if writer.transport.get_write_buffer_size() > 64 * 1024:
+                    await writer.drain()
+            await writer.drain()
+            self.replays_count += 1
+        except ConnectionError:
+            logger.debug('listener is disconnected')
+        finally:
+            writer.close()
+
+    async def start(self, host: str, port: int) -> asyncio.AbstractServer:
+        return await asyncio.start_server(self.handle_listener, host, port)
+
+
+async def main(options: Options) -> None:
+    if not options.replay:
+        await record(options.host, options.port, options.capture_path, options.duration)
+        return
+
+    replay_server = ReplayServer(options.capture_path, options.speed)
+    server = await replay_server.start(options.replay_host, options.replay_port)
+    logger.info('replay %d chunks on %s:%s', len(replay_server.chunks),
+                options.replay_host, options.replay_port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    parser = argparse.ArgumentParser(
+        prog='Chat capture',
+        description='Capture inbound bytes of chat and replay them to listeners',
+    )
+
+    parser.add_argument('-host', '--host', type=str, default=None,
+                        help='host of chat to capture')
+    parser.add_argument('-p', '--port', type=int, default=None,
+                        help='port of chat to capture')
+    parser.add_argument('-cp', '--capture_path', type=Path, required=True,
+                        help='path to capture file')
+    parser.add_argument('-d', '--duration', type=float, default=None,
+                        help='seconds of capture, '
+                             'by default until chat closes connection')
+    parser.add_argument('-r', '--replay', action='store_true', default=False,
+                        help='serve capture to listeners instead of capturing')
+    parser.add_argument('-rh', '--replay_host', type=str, default='127.0.0.1',
+                        help='host to serve replay')
+    parser.add_argument('-rp', '--replay_port', type=int, default=5000,
+                        help='port to serve replay')
+    parser.add_argument('-s', '--speed', type=float, default=1.0,
+                        help='speed of replay, 1 is original, 0 is as fast as possible')
+    parser.add_argument('-l', '--logging', action='store_true', default=False,
+                        help='is do logging')
+
+    args = parser.parse_args()
+    if not args.replay and not (args.host and args.port):
+        parser.error('host and port are required for capture')
+
+    options = Options(**args.__dict__)
+
+    if not options.logging:
+        logging.disable()
+
+    try:
+        asyncio.run(main(options))
+    except KeyboardInterrupt:
+        pass
@@ -1,34 +1,236 @@
 import argparse
 import asyncio
-from dataclasses import dataclass
-import datetime
+from dataclasses import dataclass, field
 import logging
 from pathlib import Path
+import platform
+import signal
+from typing import Optional
 
-import aiofiles
+import anyio
 
 from context_managers import open_connection
+from history import HistorySink
+import metrics
+from queues import BoundedQueue, OverflowPolicy
+from reconnect import ReconnectPolicy
+from search import SearchIndex
 
 logger = logging.getLogger(__name__)
 
 
 @dataclass
-class Options:
+class Channel:
     host: str
     port: int
     history_path: Path
+    received_count: int = 0
+    received_bytes: int = 0
+
+    def __str__(self):
+        if ':' in self.host:
+            return f'[{self.host}]:{self.port}'
+        return f'{self.host}:{self.port}'
+
+
+@dataclass
+class Options:
+    host: Optional[str]
+    port: Optional[int]
+    history_path: Optional[Path]
     logging: bool
+    flush_size: int = 100
+    flush_interval: float = 1.0
+    fsync: bool = False
+    daemon: bool = False
+    targets: list[Channel] = field(default_factory=list)
+    reconnect: bool = True
+    stats_interval: float = 0
+    metrics_port: Optional[int] = None
+    metrics_path: Optional[Path] = None
+    metrics_interval: float = 10.0
+    rotate_size: int = 0
+    rotate_daily: bool = False
+    search_index: bool = False
+
+    def get_channels(self) -> list[Channel]:
+        channels = list(self.targets)
+        if self.host:
+            if not self.port or self.history_path is None:
+                raise ValueError('port and history path are required with host')
+            channels.append(Channel(self.host, self.port, self.history_path))
+        return channels
+
+
+def parse_target(target: str) -> Channel:
+    """Parse channel from HOST:PORT:HISTORY_PATH, IPv6 host is in brackets"""
+    try:
+        if target.startswith('['):
+            host, rest = target[1:].split(']:', 1)
+        else:
+            host, rest = target.split(':', 1)
+        port, history_path = rest.split(':', 1)
+        port = int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{target} is not HOST:PORT:HISTORY_PATH')
+
+    if not host or not history_path or not 0 < port < 65536:
+        raise argparse.ArgumentTypeError(f'{target} is not HOST:PORT:HISTORY_PATH')
+    return Channel(host, port, Path(history_path))
+
+
+async def read_chat(reader: asyncio.StreamReader, messages_queue: asyncio.Queue,
+                    channel: Channel) -> None:
+    while not reader.at_eof():
+        message = await reader.readline()
+        if not message:
+            break
+        channel.received_count += 1
+        channel.received_bytes += len(message)
+        # one broken line of chat doesn't stop listening
+        message = message.decode(errors='replace').strip()
+        logger.debug('RECEIVE: %s', message)
+        await messages_queue.put(message)
+
+
+async def read_chat_blocks(reader: asyncio.StreamReader, blocks_queue: asyncio.Queue,
+                           channel: Channel, chunk_size: int = 64 * 1024) -> None:
+    """
+    Read chat by chunks and put blocks of whole lines in queue without decoding.
+
+    ASCII whitespace around every line is stripped, so history has the same lines
+    as in line mode for readers and dedup
+    """
+    tail = b''
+    while True:
+        chunk = await reader.read(chunk_size)
+        if not chunk:
+            break
+
+        data = tail + chunk if tail else chunk
+        end = data.rfind(b'\n')
+        if end == -1:
+            tail = data
+            continue
+
+        tail = data[end + 1:]
+        block = data[:end]
+        channel.received_count += block.count(b'\n') + 1
+        channel.received_bytes += end + 1
+        block = strip_lines(block)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('RECEIVE: %s', block.decode(errors='replace'))
+        await blocks_queue.put(block)
+
+    if tail:
+        channel.received_count += 1
+        channel.received_bytes += len(tail)
+        await blocks_queue.put(strip_lines(tail))
+
+
+def strip_lines(block: bytes) -> bytes:
+    """Strip ASCII whitespace around every line of block"""
+    # split and join of lines is several times faster than regex substitution
+    return b'\n'.join([line.strip() for line in block.split(b'\n')])
+
+
+async def listen_channel(channel: Channel, options: Options) -> None:
+    """Listen channel and reconnect if connection is lost, history file stays open"""
+    sink = HistorySink(channel.history_path, flush_size=options.flush_size,
+                       flush_interval=options.flush_interval, fsync=options.fsync,
+                       rotate_size=options.rotate_size * 1024 * 1024,
+                       rotate_daily=options.rotate_daily)
+    # reading waits for saving when disk is slow
+    if options.daemon:
+        messages_queue = BoundedQueue(64, OverflowPolicy.BLOCK)
+        read = read_chat_blocks
+    else:
+        messages_queue = BoundedQueue(10000, OverflowPolicy.BLOCK)
+        read = read_chat
+
+    # counters of channel are read only on export, reading loop doesn't call metrics
+    name = str(channel)
+    metrics.counter('chat_received_messages_total', 'Messages received from chat',
+                    lambda: channel.received_count, channel=name)
+    metrics.counter('chat_received_bytes_total', 'Bytes of messages received from chat',
+                    lambda: channel.received_bytes, channel=name)
+    metrics.gauge('chat_queue_size', 'Count of items in queue', messages_queue.qsize,
+                  queue='messages_to_file', channel=name)
+    reconnects = metrics.counter('chat_reconnects_total', 'Reconnects to chat',
+                                 channel=name)
+
+    reconnect_policy = ReconnectPolicy()
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(sink.run, messages_queue)
+        if options.search_index:
+            # index reads history file after sink, so it never slows down receiving
+            tg.start_soon(SearchIndex(channel.history_path).run)
+        while True:
+            reconnect_policy.attempt()
+            try:
+                async with open_connection(channel.host, channel.port) as (reader, _):
+                    # chat replays recent messages on connection, so only time
+                    # of connection proves that it is healthy
+                    reconnect_policy.record_connected()
+                    await read(reader, messages_queue, channel)
+                logger.warning('%s: connection is closed', channel)
+            except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+                # line over the limit of stream is ValueError, error of one channel
+                # doesn't cancel the others
+                logger.warning('%s: connection error %r', channel, e)
+
+            if not options.reconnect:
+                break
+            reconnects.inc()
+            delay = reconnect_policy.next_delay()
+            logger.warning('%s: reconnect in %.1fs', channel, delay)
+            await anyio.sleep(delay)
+
+        tg.cancel_scope.cancel()
+
+
+async def report_stats(channels: list[Channel], interval: float) -> None:
+    """Print received lines per second in all channels every interval seconds"""
+    previous_counts = [channel.received_count for channel in channels]
+    while True:
+        await anyio.sleep(interval)
+        counts = [channel.received_count for channel in channels]
+        rates = [(count - previous) / interval
+                 for count, previous in zip(counts, previous_counts)]
+        previous_counts = counts
+        details = ', '.join(f'{channel} {rate:.0f}'
+                            for channel, rate in zip(channels, rates))
+        print(f'{sum(rates):.0f} lines/sec in {len(channels)} channels ({details})')
 
 
 async def echo_chat(options: Options) -> None:
-    async with open_connection(options.host, options.port) as (reader, writer):
-        async with aiofiles.open(options.history_path, 'a', encoding='UTF8') as f:
-            while not reader.at_eof():
-                message = await reader.readline()
-                formatted_now = datetime.datetime.now().strftime('%d.%m.%y %H:%M')
-                message = f'[{formatted_now}] {message.decode()}'
-                logger.debug(f'RECEIVE: {message.strip()}')
-                await f.write(message)
+    """Listen all channels concurrently, every channel has its own history file"""
+    channels = options.get_channels()
+    async with anyio.create_task_group() as tg:
+        if options.stats_interval:
+            tg.start_soon(report_stats, channels, options.stats_interval)
+
+        async with anyio.create_task_group() as channels_tg:
+            for channel in channels:
+                channels_tg.start_soon(listen_channel, channel, options)
+
+        tg.cancel_scope.cancel()
+
+
+async def main(options: Options) -> None:
+    if platform.system() != 'Windows':
+        # cancellation of the task flushes history sink
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+    try:
+        async with anyio.create_task_group() as tg:
+            tg.start_soon(metrics.export, options.metrics_port, options.metrics_path,
+                          options.metrics_interval)
+            await echo_chat(options)
+            tg.cancel_scope.cancel()
+    except asyncio.CancelledError:
+        logger.info('stopped by SIGTERM')
 
 
 if __name__ == '__main__':
@@ -38,22 +240,58 @@ if __name__ == '__main__':
         description='Script for chat listening and write in file',
     )
 
-    parser.add_argument('-host', '--host', type=str, required=True, help='host of chat')
-    parser.add_argument('-p', '--port', type=int, required=True, help='port of chat')
+    parser.add_argument('-host', '--host', type=str, default=None, help='host of chat')
+    parser.add_argument('-p', '--port', type=int, default=None, help='port of chat')
     parser.add_argument(
         '-hp',
         '--history_path',
         type=Path,
-        required=True,
+        default=None,
         help='path to file with messages',
     )
+    parser.add_argument('-t', '--target', dest='targets', type=parse_target,
+                        action='append', default=[],
+                        help='one more chat to listen as HOST:PORT:HISTORY_PATH, '
+                             'IPv6 host is in brackets')
+    parser.add_argument('-si', '--stats_interval', type=float, default=0,
+                        help='print received lines per second every interval seconds, '
+                             '0 is never')
     parser.add_argument('-l', '--logging', action='store_true', default=False, help='is do logging')
+    parser.add_argument('-fs', '--flush_size', type=int, default=100,
+                        help='count of messages to write in history file at once')
+    parser.add_argument('-fi', '--flush_interval', type=float, default=1.0,
+                        help='max seconds which message waits '
+                             'before writing in history file')
+    parser.add_argument('--fsync', action='store_true', default=False,
+                        help='sync history file to disk after every write')
+    parser.add_argument('-d', '--daemon', action='store_true', default=False,
+                        help='write received lines as is without decoding '
+                             'for max throughput')
+    parser.add_argument('-rs', '--rotate_size', type=int, default=0,
+                        help='megabytes of history file to compress it in archive, '
+                             '0 is never')
+    parser.add_argument('--rotate_daily', action='store_true', default=False,
+                        help='compress history file in archive every day')
+    parser.add_argument('--search_index', action='store_true', default=False,
+                        help='keep full-text search index of history')
+    parser.add_argument('--metrics_port', type=int, default=None,
+                        help='serve metrics in Prometheus format on localhost port')
+    parser.add_argument('--metrics_path', type=Path, default=None,
+                        help='dump metrics in json file every metrics interval')
+    parser.add_argument('--metrics_interval', type=float, default=10.0,
+                        help='seconds between dumps of metrics')
 
     args = parser.parse_args()
+    if not args.targets and not args.host:
+        parser.error('host, port and history path or at least one target are required')
+    if args.host and not (args.port and args.history_path):
+        parser.error('port and history path are required with host')
 
     options = Options(**args.__dict__)
+    if options.metrics_port is not None or options.metrics_path is not None:
+        metrics.enable()
 
     if not options.logging:
         logging.disable()
 
-    asyncio.run(echo_chat(options))
+    asyncio.run(main(options))
@@ -1,122 +1,395 @@
 import argparse
 import asyncio
+from contextlib import nullcontext
 from dataclasses import dataclass
+import itertools
 import json
 import logging
+import os
 from pathlib import Path
 import platform
+import socket
+import stat
+import struct
+import sys
+import time
+from typing import Iterable, Iterator, Optional
 
-import aiofiles
+import anyio
 
 from context_managers import open_connection
+from credentials import CredentialStore
+import metrics
 
 logger = logging.getLogger(__name__)
 
 
+def get_daemon_socket_path() -> Path:
+    """
+    Default socket of writer daemon in directory which only the current user can access.
+
+    It is the runtime directory of the user or chat_writer directory in ~/.cache
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return Path(runtime_dir) / 'chat_writer.sock'
+
+    socket_dir = Path.home() / '.cache' / 'chat_writer'
+    socket_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+    # directory could be created before with default mode
+    socket_dir.chmod(0o700)
+    return socket_dir / 'chat_writer.sock'
+
+
+def is_own_socket(path: Path) -> bool:
+    """Check that path is unix socket of the current user, token isn't sent to stranger"""
+    try:
+        path_stat = os.stat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(path_stat.st_mode) and path_stat.st_uid == os.getuid()
+
+
+def is_own_peer(writer: asyncio.StreamWriter) -> bool:
+    """Check that process on the other side of unix socket runs by the current user"""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        # owner of socket file is checked already
+        return True
+    credentials = writer.get_extra_info('socket').getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    _, uid, _ = struct.unpack('3i', credentials)
+    return uid == os.getuid()
+
+
 @dataclass
 class Options:
     host: str
     port: int
     message: str
+    messages_path: Optional[Path]
     token: str
     username: str
     credential_path: Path
     logging: bool
+    credential_index_path: Optional[Path] = None
+    bulk: bool = False
+    metrics_port: Optional[int] = None
+    metrics_path: Optional[Path] = None
+    metrics_interval: float = 10.0
+    daemon_socket_path: Optional[Path] = None
+    direct: bool = False
 
 
-async def write_message(writer: asyncio.StreamWriter, text: str) -> None:
+async def write_message(writer: asyncio.StreamWriter, text: str,
+                        drain: bool = True) -> int:
+    """
+    Write text in stream and return count of written bytes.
+
+    Without drain the text is only buffered, writing waits for the socket only when
+    the buffer is above transport high water mark, it allows to pipeline messages
+    """
     text = text.encode()
-    logger.debug(f'SEND: {text}')
+    logger.debug('SEND: %r', text)
     writer.write(text)
-    await writer.drain()
+    if drain:
+        await writer.drain()
+        return len(text)
 
+    transport = writer.transport
+    _, high_water = transport.get_write_buffer_limits()
+    if transport.get_write_buffer_size() > high_water:
+        # drain waits until buffer is below low water mark
+        await writer.drain()
+    return len(text)
 
-async def register(options: Options) -> dict[str, str]:
+
+async def register(options: Options, credential_store: CredentialStore,
+                   reader: asyncio.StreamReader,
+                   writer: asyncio.StreamWriter) -> dict[str, str]:
+    """
+    Register new user in connection where greeting is already read.
+
+    After registration connection is authorized by new token
+    """
     logger.info('registration...')
-    async with open_connection(options.host, options.port) as (reader, writer):
-        greeting_msg = await reader.readline()
-        logger.debug(f'RECEIVE: {greeting_msg.decode().strip()}')
+    # send null for registration
+    await write_message(writer, '\n')
 
-        # send null for registration
-        await write_message(writer, '\n')
+    instruction_msg = await reader.readline()
+    logger.debug(f'RECEIVE: {instruction_msg.decode().strip()}')
 
-        instruction_msg = await reader.readline()
-        logger.debug(f'RECEIVE: {instruction_msg.decode().strip()}')
+    await write_message(writer, f'{options.username}\n')
 
-        await write_message(writer, f'{options.username}\n')
+    credentials_msg = await reader.readline()
+    logger.debug(f'RECEIVE: {credentials_msg.decode().strip()}')
 
-        credentials_msg = await reader.readline()
-        logger.debug(f'RECEIVE: {credentials_msg.decode().strip()}')
+    credentials = json.loads(credentials_msg.decode().strip())
 
-        credentials = json.loads(credentials_msg.decode().strip())
+    # welcome is sent after credentials, it isn't a reply on any message
+    welcome_msg = await reader.readline()
+    logger.debug(f'RECEIVE: {welcome_msg.decode().strip()}')
 
-    async with aiofiles.open(options.credential_path, 'a', encoding='UTF8') as f:
-        await f.write(json.dumps(credentials) + '\n')
+    credential_store.add(credentials)
 
     logger.info('success registration')
     return credentials
 
 
-async def submit_message(options: Options) -> None:
+async def submit_message(writer: asyncio.StreamWriter, message: str,
+                         drain: bool = True) -> int:
     """
-    Submit message in chat.
+    Submit message in chat and return count of written bytes.
 
-    In this function token always in options and always valid
+    Connection of writer is always authorized. Blank lines are removed from message,
+    chat would send every part before them as a separate message with its own reply
     """
-    logger.info('submit message...')
-    async with open_connection(options.host, options.port) as (reader, writer):
-        greeting_msg = await reader.readline()
-        logger.debug(f'RECEIVE: {greeting_msg.decode().strip()}')
+    message = '\n'.join(line for line in message.split('\n') if line.strip())
+    # double \n because chat require empty string for message sending,
+    # empty message is the empty string only
+    bytes_count = await write_message(writer, f'{message}\n\n' if message else '\n',
+                                      drain)
+    logger.info('message submitted')
+    return bytes_count
+
+
+async def read_reply(reader: asyncio.StreamReader) -> None:
+    """Read reply of chat on submitted message, raise ConnectionError if chat closed"""
+    reply = await reader.readline()
+    if not reply:
+        raise ConnectionError('connection is closed by chat')
+    logger.debug(f'RECEIVE: {reply.decode().strip()}')
+
+
+async def skip_replies(reader: asyncio.StreamReader) -> None:
+    """Read replies of chat on submitted messages, so chat doesn't wait for reading"""
+    while await reader.read(64 * 1024):
+        pass
+
+
+async def submit_messages_bulk(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                               messages: Iterable[str]) -> int:
+    """Submit messages without waiting for socket after every one, return their count"""
+    skipping_task = asyncio.create_task(skip_replies(reader))
+    messages_count = 0
+    bytes_count = 0
+    try:
+        for message in messages:
+            bytes_count += await submit_message(writer, message, drain=False)
+            messages_count += 1
+        await writer.drain()
+    finally:
+        skipping_task.cancel()
+        # metrics are updated once, so loop of submission is the same without them
+        metrics.counter('chat_sent_messages_total', 'Messages sent in chat').inc(
+            messages_count)
+        metrics.counter('chat_sent_bytes_total', 'Bytes sent in chat').inc(bytes_count)
+    return messages_count
+
+
+async def authorize(options: Options, credential_store: CredentialStore,
+                    reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+    """
+    Authorization from db data by mane or by token from args in connection where
+    greeting is already read. If there is no token, nothing is sent
 
-        await write_message(writer, f'{options.token}\n')
+    Return bool value of authorization result
+    """
+    logger.info('authorization...')
+    # token more prior than username
+    if options.username and not options.token:
+        token = credential_store.get_token(options.username)
+        if token is None:
+            return False
+        options.token = token
 
-        authorization_msg = await reader.readline()
-        logger.debug(f'RECEIVE: {authorization_msg.decode().strip()}')
+    if not options.token:
+        return False
 
-        # double \n because chat require empty string for message sending
-        await write_message(writer, f'{options.message}\n\n')
+    await write_message(writer, f'{options.token}\n')
 
-        logger.info('message submitted')
+    credentials_msg = await reader.readline()
+    logger.debug(f'RECEIVE: {credentials_msg.decode().strip()}')
 
+    if not json.loads(credentials_msg.decode().strip()):
+        logger.error(f'Wrong token {options.token}')
+        return False
 
-async def authorize(options: Options) -> bool:
-    """
-    Authorization from db data by mane or by token from args
+    # welcome is sent after credentials, it isn't a reply on any message
+    welcome_msg = await reader.readline()
+    logger.debug(f'RECEIVE: {welcome_msg.decode().strip()}')
 
-    Return bool value of authorization result
-    """
-    logger.info('authorization...')
-    async with open_connection(options.host, options.port) as (reader, writer):
+    logger.info('success authorization')
+    return True
 
-        greeting_msg = await reader.readline()
-        logger.debug(f'RECEIVE: {greeting_msg.decode().strip()}')
 
-        # token more prior than username
-        if options.username and not options.token:
-            creds_found = False
-            options.credential_path.touch()
-            async with aiofiles.open(options.credential_path, encoding='UTF8') as f:
-                async for line in f:
-                    creds = json.loads(line)
+def read_messages(options: Options) -> Iterator[str]:
+    """
+    Messages from args or lines of messages file, stdin if there are no both.
 
-                    if creds['nickname'] == options.username:
-                        creds_found = True
-                        options.token = creds['account_hash']
-                        break
-            if not creds_found:
-                return False
+    Lines of .jsonl file are json strings or objects with message key. Lines are read
+    synchronously, so the loop is blocked until the next line of stdin is written,
+    nothing is sent or read in chat meanwhile
+    """
+    if options.message:
+        yield options.message
+        return
 
-        await write_message(writer, f'{options.token}\n')
+    if options.messages_path is None or str(options.messages_path) == '-':
+        # stdin isn't closed, it isn't opened here
+        messages_file = nullcontext(sys.stdin)
+    else:
+        messages_file = open(options.messages_path, encoding='UTF8')
+
+    is_jsonl = (options.messages_path is not None
+                and options.messages_path.suffix == '.jsonl')
+    with messages_file as f:
+        for line in f:
+            message = line.rstrip('\n')
+            if message and is_jsonl:
+                message = json.loads(message)
+                if isinstance(message, dict):
+                    message = message['message']
+            if message:
+                yield message
+
+
+async def submit_via_daemon(options: Options, token: str,
+                            messages: Iterator[str]) -> Optional[int]:
+    """
+    Hand messages off to writer daemon and return count of messages submitted by it.
 
-        credentials_msg = await reader.readline()
-        logger.debug(f'RECEIVE: {credentials_msg.decode().strip()}')
+    If daemon isn't running, isn't owned by the current user or can't authorize,
+    None is returned and messages aren't read yet. If daemon is lost in the middle,
+    the rest of messages stay in iterator. Handed off messages which aren't
+    submitted are reported in stderr
+    """
+    socket_path = options.daemon_socket_path or get_daemon_socket_path()
+    if platform.system() == 'Windows' or not is_own_socket(socket_path):
+        logger.debug('daemon is not running on %s', socket_path)
+        return None
+    try:
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+    except OSError:
+        logger.debug('daemon is not running on %s', socket_path)
+        return None
+    if not is_own_peer(writer):
+        # socket could be replaced after the check of its owner
+        logger.warning('daemon on %s is run by another user', socket_path)
+        writer.close()
+        return None
+
+    handed_off_count = 0
+    submitted_count = 0
+    # it is known only from the last answer of daemon
+    failed_count = None
+
+    async def read_confirmations() -> None:
+        nonlocal submitted_count, failed_count
+        while line := await reader.readline():
+            answer = json.loads(line)
+            submitted_count = answer['submitted']
+            failed_count = answer.get('failed')
+
+    try:
+        header = {'host': options.host, 'port': options.port, 'token': token}
+        writer.write(json.dumps(header).encode() + b'\n')
+        answer = json.loads(await reader.readline() or 'null')
+        if not answer or 'error' in answer:
+            logger.warning('daemon refused messages: %s', answer and answer['error'])
+            return None
+
+        # daemon confirms submitted messages while they are sent and closes connection
+        confirmations_task = asyncio.create_task(read_confirmations())
+        try:
+            for message in messages:
+                if confirmations_task.done():
+                    raise ConnectionError('daemon closed connection')
+                writer.write(json.dumps(message).encode() + b'\n')
+                handed_off_count += 1
+                await writer.drain()
+            writer.write_eof()
+            await confirmations_task
+        finally:
+            confirmations_task.cancel()
+    except ConnectionError as e:
+        logger.debug('daemon connection error %r', e)
+    finally:
+        writer.close()
+
+    if failed_count is None:
+        lost_count = handed_off_count - submitted_count
+        logger.error('daemon is lost, %d messages are submitted, '
+                     '%d handed off messages may be lost', submitted_count, lost_count)
+        print(f'daemon is lost, {lost_count} messages may be not submitted',
+              file=sys.stderr)
+    elif failed_count:
+        logger.error('%d messages are submitted by daemon, %d failed',
+                     submitted_count, failed_count)
+        print(f'{failed_count} messages are not submitted by daemon', file=sys.stderr)
+    else:
+        logger.info('%d messages are submitted by daemon', submitted_count)
+    return submitted_count
+
+
+async def write_chat(options: Options) -> None:
+    with CredentialStore(options.credential_path,
+                         options.credential_index_path) as credential_store:
+        await write_chat_messages(options, credential_store)
+
+
+async def write_chat_messages(options: Options,
+                              credential_store: CredentialStore) -> None:
+    messages = read_messages(options)
+    if not options.direct and not options.bulk:
+        token = options.token
+        if options.username and not token:
+            token = credential_store.get_token(options.username)
+        # new user is registered only by direct connection
+        messages_count = None
+        if token:
+            messages_count = await submit_via_daemon(options, token, messages)
+        if messages_count is not None:
+            metrics.counter('chat_sent_messages_total', 'Messages sent in chat').inc(
+                messages_count)
+            next_message = next(messages, None)
+            if next_message is None:
+                return
+            logger.warning('the rest of messages are sent directly')
+            messages = itertools.chain([next_message], messages)
 
-        if json.loads(credentials_msg.decode().strip()):
-            logger.error(f'Wrong token {options.token}')
-            return False
+    async with open_connection(options.host, options.port) as (reader, writer):
+        started_at = time.perf_counter()
+        greeting_msg = await reader.readline()
+        logger.debug(f'RECEIVE: {greeting_msg.decode().strip()}')
 
-    logger.info('success authorization')
-    return True
+        is_authorize = await authorize(options, credential_store, reader, writer)
+        if not is_authorize and not options.token:
+            credentials = await register(options, credential_store, reader, writer)
+            options.token = credentials['account_hash']
+        elif not is_authorize:
+            return
+        handshake_seconds = metrics.histogram('chat_handshake_seconds',
+                                              'Time of greeting and authorization')
+        handshake_seconds.observe(time.perf_counter() - started_at)
+
+        # now connection is authorized by token from args, from cache or from registration
+        if options.bulk:
+            started_at = time.monotonic()
+            messages_count = await submit_messages_bulk(reader, writer, messages)
+            elapsed = time.monotonic() - started_at
+            rate = messages_count / elapsed if elapsed else float('inf')
+            print(f'{messages_count} messages submitted in {elapsed:.3f}s, '
+                  f'{rate:.0f} messages/sec')
+            return
+
+        sent_messages = metrics.counter('chat_sent_messages_total',
+                                        'Messages sent in chat')
+        sent_bytes = metrics.counter('chat_sent_bytes_total', 'Bytes sent in chat')
+        for message in messages:
+            sent_bytes.inc(await submit_message(writer, message))
+            # chat stops reading when its replies aren't read, so one is read per message
+            await read_reply(reader)
+            sent_messages.inc()
 
 
 async def main() -> None:
@@ -128,12 +401,34 @@ async def main() -> None:
 
     parser.add_argument('-host', '--host', type=str, required=True, help='host of chat')
     parser.add_argument('-p', '--port', type=int, required=True, help='port of chat')
-    parser.add_argument('-m', '--message', type=str, required=True, help='message to send')
+    parser.add_argument('-m', '--message', type=str, default='', help='message to send')
+    parser.add_argument('-mp', '--messages_path', type=Path, default=None,
+                        help='path to file with message per line to send, '
+                             '"-" or nothing for stdin')
     parser.add_argument('-t', '--token', type=str, default='', help='token of registered user')
     parser.add_argument('-u', '--username', type=str, default='', help='username for new user or cached')
     parser.add_argument('-cp', '--credential_path', type=Path,
                         default=Path('creds.jsonstream'), help='path with credentials')
+    parser.add_argument('-ci', '--credential_index_path', type=Path, default=None,
+                        help='path to sqlite index of credentials '
+                             'for fast search by username')
     parser.add_argument('-l', '--logging', action='store_true', default=False, help='is do logging')
+    parser.add_argument('-b', '--bulk', action='store_true', default=False,
+                        help='send messages without waiting for every one '
+                             'and report speed')
+    parser.add_argument('-ds', '--daemon_socket_path', type=Path, default=None,
+                        help='unix socket of writer daemon, '
+                             'messages are sent directly if it is not running')
+    parser.add_argument('--direct', action='store_true', default=False,
+                        help='send messages by own connection '
+                             'even if writer daemon is running')
+    parser.add_argument('--metrics_port', type=int, default=None,
+                        help='serve metrics in Prometheus format on localhost port')
+    parser.add_argument('--metrics_path', type=Path, default=None,
+                        help='dump metrics in json file every metrics interval '
+                             'and on exit')
+    parser.add_argument('--metrics_interval', type=float, default=10.0,
+                        help='seconds between dumps of metrics')
 
     args = parser.parse_args()
 
@@ -142,15 +437,14 @@ async def main() -> None:
     if not options.logging:
         logging.disable()
 
-    is_authorize = await authorize(options)
-    if not is_authorize and not options.token:
-        credentials = await register(options)
-        options.token = credentials['account_hash']
-    elif not is_authorize:
-        return
+    if options.metrics_port is not None or options.metrics_path is not None:
+        metrics.enable()
 
-    # now we have token from args if success authorization or from registration
-    await submit_message(options)
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(metrics.export, options.metrics_port, options.metrics_path,
+                      options.metrics_interval)
+        await write_chat(options)
+        tg.cancel_scope.cancel()
 
 
 if __name__ == '__main__':
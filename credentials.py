@@ -0,0 +1,140 @@
+import json
+import logging
+from pathlib import Path
+import sqlite3
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CredentialStore:
+    """
+    Nickname to token index over append only file with json credentials.
+
+    File is parsed once, after that only appended lines are read. With index_path
+    the index is also kept in sqlite, so next processes read only lines appended
+    after the last run.
+
+    If nickname is registered many times, the first token is used
+    """
+
+    def __init__(self, path: Path, index_path: Optional[Path] = None):
+        self.path = path
+        self._tokens = {}
+        # count of already indexed bytes of credentials file
+        self._offset = 0
+
+        self._db = None
+        if index_path is not None:
+            self._db = sqlite3.connect(index_path)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS creds '
+                '(nickname TEXT PRIMARY KEY, token TEXT NOT NULL)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta (offset INTEGER NOT NULL)')
+            row = self._db.execute('SELECT offset FROM meta').fetchone()
+            if row is None:
+                self._db.execute('INSERT INTO meta (offset) VALUES (0)')
+            else:
+                self._offset = row[0]
+
+        self.refresh()
+
+    def get_token(self, nickname: str) -> Optional[str]:
+        token = self._tokens.get(nickname)
+        if token is not None:
+            return token
+
+        if self._db is not None:
+            row = self._db.execute(
+                'SELECT token FROM creds WHERE nickname = ?', (nickname,)).fetchone()
+            if row is not None:
+                self._tokens[nickname] = row[0]
+                return row[0]
+
+        # file can be appended by another process
+        if self.refresh():
+            return self._tokens.get(nickname)
+        return None
+
+    def refresh(self) -> int:
+        """Index lines appended after the last refresh, return count of them"""
+        if not self.path.exists():
+            return 0
+
+        with open(self.path, 'rb') as f:
+            size = f.seek(0, 2)
+            if size < self._offset:
+                logger.warning(f'{self.path} is truncated, rebuild credentials index')
+                self._reset()
+            if size == self._offset:
+                return 0
+
+            f.seek(self._offset)
+            data = f.read(size - self._offset)
+
+        # last line can be written right now, it will be read on next refresh
+        complete_size = data.rfind(b'\n') + 1
+        new_creds = []
+        for line in data[:complete_size].splitlines():
+            if line.strip():
+                new_creds.append(json.loads(line))
+
+        self._index(new_creds, self._offset + complete_size)
+        return len(new_creds)
+
+    def add(self, credentials: dict[str, Any]) -> None:
+        """Append credentials to file and to index"""
+        self.add_many([credentials])
+
+    def add_many(self, credentials_list: list[dict[str, Any]]) -> None:
+        """
+        Append many credentials to file and to index by one write.
+
+        Another process can append lines after the last refresh, then indexed offset
+        stays before them and they are read with ours on the next refresh
+        """
+        if not credentials_list:
+            return
+        self.refresh()
+        data = b''.join(json.dumps(creds).encode() + b'\n' for creds in credentials_list)
+        with open(self.path, 'ab') as f:
+            f.write(data)
+            end = f.tell()
+
+        offset = self._offset
+        if end - len(data) == offset:
+            # nothing was appended between the refresh and our write
+            offset = end
+        self._index(credentials_list, offset)
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def __enter__(self) -> 'CredentialStore':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _index(self, new_creds: list[dict[str, Any]], offset: int) -> None:
+        for creds in new_creds:
+            self._tokens.setdefault(creds['nickname'], creds['account_hash'])
+        self._offset = offset
+
+        if self._db is not None:
+            with self._db:
+                self._db.executemany(
+                    'INSERT OR IGNORE INTO creds (nickname, token) VALUES (?, ?)',
+                    ((creds['nickname'], creds['account_hash']) for creds in new_creds),
+                )
+                self._db.execute('UPDATE meta SET offset = ?', (offset,))
+
+    def _reset(self) -> None:
+        self._tokens = {}
+        self._offset = 0
+        if self._db is not None:
+            with self._db:
+                self._db.execute('DELETE FROM creds')
+                self._db.execute('UPDATE meta SET offset = 0')
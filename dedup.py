@@ -0,0 +1,64 @@
+from collections import OrderedDict
+from pathlib import Path
+
+from history import HistoryArchive, HistoryReader, TimestampFormatter
+from message import ChatMessage
+
+
+class RecentMessages:
+    """
+    Fingerprints of the last capacity messages to drop replay of chat after reconnect.
+
+    Chat sends recent messages again to every new connection. After resume, messages
+    which are already seen are dropped until the first new one. It is the resume point,
+    after it every message is accepted, so repeated text in live chat is not lost.
+    Fingerprint is hash of raw line, so messages are not decoded for it.
+    Every operation is O(1), memory is limited by capacity fingerprints
+    """
+
+    def __init__(self, capacity: int = 10000):
+        self.capacity = capacity
+        self.resuming = False
+        self.dropped_count = 0
+        # fingerprint -> None from the oldest to the newest
+        self._fingerprints = OrderedDict()
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    def seed_from_history(self, path: Path) -> None:
+        """Remember messages of history tail, so replay on first connection is dropped"""
+        if not self.capacity:
+            return
+        timestamps = TimestampFormatter()
+        reader = HistoryReader(path, archive=HistoryArchive(path))
+        for line in reader.read_previous(self.capacity):
+            raw = line.encode()
+            _, prefix_size = timestamps.parse(raw)
+            self.add(raw[prefix_size:].strip())
+
+    def resume(self) -> None:
+        """Call when connection is established, before reading of the first message"""
+        self.resuming = True
+
+    def accept(self, message: ChatMessage) -> bool:
+        """Remember message and return False if it is replay of already seen one"""
+        fingerprint = hash(message.raw)
+        if self.resuming:
+            if fingerprint in self._fingerprints:
+                self.dropped_count += 1
+                return False
+            self.resuming = False
+        self._add(fingerprint)
+        return True
+
+    def add(self, raw: bytes) -> None:
+        self._add(hash(raw))
+
+    def _add(self, fingerprint: int) -> None:
+        if fingerprint in self._fingerprints:
+            self._fingerprints.move_to_end(fingerprint)
+            return
+        self._fingerprints[fingerprint] = None
+        if len(self._fingerprints) > self.capacity:
+            self._fingerprints.popitem(last=False)
@@ -0,0 +1,238 @@
+import argparse
+import asyncio
+from dataclasses import dataclass
+import json
+import logging
+import time
+from typing import Optional
+import uuid
+
+logger = logging.getLogger(__name__)
+
+GREETING = (b'Hello %username%! Enter your personal hash '
+            b'or leave it empty to create new account.\n')
+NICKNAME_REQUEST = b'Enter preferred nickname below:\n'
+WELCOME = b'Welcome to chat! Post your message below. End it with an empty line.\n'
+MESSAGE_SENT = b'Message send. Write more, end message with an empty line.\n'
+
+
+@dataclass
+class Options:
+    host: str
+    listen_port: int
+    write_port: int
+    rate: float
+    count: int
+    logging: bool
+
+
+class FakeChat:
+    """
+    Local stand-in of chat server with the same protocol.
+
+    Writers get greeting, then send token or empty line and nickname for registration,
+    reply to token is json credentials or null. Message ends with empty line, every empty
+    line is answered. Submitted messages are sent to all listeners.
+
+    Listeners also receive generated messages, rate is messages per second
+    (0 is no generated messages, inf is as fast as possible). If count is not 0,
+    listener connection is closed after count generated messages
+    """
+
+    def __init__(self, rate: float = 0, count: int = 0, batch_size: int = 1000):
+        self.rate = rate
+        self.count = count
+        self.batch_size = batch_size
+
+        self.tokens = {}
+        self.listeners = set()
+        self.connections = set()
+        self.connections_count = 0
+        self.received_count = 0
+        self._received_events = []
+
+    def register(self, nickname: str) -> dict[str, str]:
+        token = str(uuid.uuid4())
+        self.tokens[token] = nickname
+        return {'nickname': nickname, 'account_hash': token}
+
+    async def wait_received(self, count: int) -> None:
+        """Wait until writers submit count messages in total"""
+        if self.received_count >= count:
+            return
+        event = asyncio.Event()
+        self._received_events.append((count, event))
+        await event.wait()
+
+    def disconnect_all(self) -> None:
+        for writer in list(self.connections):
+            writer.transport.abort()
+
+    async def handle_listener(self, reader: asyncio.StreamReader,
+                              writer: asyncio.StreamWriter) -> None:
+        self._track(writer)
+        self.listeners.add(writer)
+        try:
+            if self.rate:
+                await self._generate(writer)
+            else:
+                await reader.read()
+        except ConnectionError:
+            logger.debug('listener is disconnected')
+        finally:
+            self.listeners.discard(writer)
+            self.connections.discard(writer)
+            writer.close()
+
+    async def handle_writer(self, reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter) -> None:
+        self._track(writer)
+        try:
+            writer.write(GREETING)
+            token = (await reader.readline()).decode().strip()
+            if token:
+                nickname = self.tokens.get(token)
+                if nickname is None:
+                    writer.write(b'null\n')
+                    await writer.drain()
+                    return
+                creds = {'nickname': nickname, 'account_hash': token}
+            else:
+                writer.write(NICKNAME_REQUEST)
+                nickname = (await reader.readline()).decode().strip()
+                creds = self.register(nickname)
+
+            writer.write(json.dumps(creds).encode() + b'\n')
+            writer.write(WELCOME)
+            await self._receive_messages(reader, writer, nickname)
+        except ConnectionError:
+            logger.debug('writer is disconnected')
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    async def _receive_messages(self, reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter, nickname: str) -> None:
+        prefix = nickname.encode() + b': '
+        message_lines = []
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+
+            if line.strip():
+                message_lines.append(line.rstrip(b'\n'))
+                continue
+
+            writer.write(MESSAGE_SENT)
+            if message_lines:
+                self._broadcast(prefix + b' '.join(message_lines) + b'\n')
+                message_lines = []
+                self._count_received()
+            if writer.transport.get_write_buffer_size() > 64 * 1024:
+                await writer.drain()
+
+    def _broadcast(self, message: bytes) -> None:
+        for listener in self.listeners:
+            listener.write(message)
+
+    def _count_received(self) -> None:
+        self.received_count += 1
+        if not self._received_events:
+            return
+        waiting = []
+        for count, event in self._received_events:
+            if self.received_count >= count:
+                event.set()
+            else:
+                waiting.append((count, event))
+        self._received_events = waiting
+
+    def _track(self, writer: asyncio.StreamWriter) -> None:
+        self.connections.add(writer)
+        self.connections_count += 1
+
+    async def _generate(self, writer: asyncio.StreamWriter) -> None:
+        sent_count = 0
+        started_at = time.monotonic()
+        while not self.count or sent_count < self.count:
+            batch_size = self.batch_size
+            if self.count:
+                batch_size = min(batch_size, self.count - sent_count)
+            writer.write(self.generate_messages(sent_count, batch_size))
+            await writer.drain()
+            sent_count += batch_size
+
+            if self.rate != float('inf'):
+                # sleep until the time of the next batch by schedule
+                await asyncio.sleep(max(0.0, started_at + sent_count / self.rate
+                                        - time.monotonic()))
+
+    @staticmethod
+    def generate_messages(start: int, count: int) -> bytes:
+        """Lines of count generated messages from number start as listener gets them"""
+        return b''.join(
+            b'bot%d: message number %d\n' % (number % 100, number)
+            for number in range(start, start + count)
+        )
+
+
+async def start_listen_server(host: str, port: int,
+                              chat: Optional[FakeChat] = None) -> asyncio.AbstractServer:
+    chat = chat or FakeChat()
+    return await asyncio.start_server(chat.handle_listener, host, port)
+
+
+async def start_write_server(host: str, port: int,
+                             chat: Optional[FakeChat] = None) -> asyncio.AbstractServer:
+    chat = chat or FakeChat()
+    return await asyncio.start_server(chat.handle_writer, host, port)
+
+
+def get_port(server: asyncio.AbstractServer) -> int:
+    return server.sockets[0].getsockname()[1]
+
+
+async def main(options: Options) -> None:
+    chat = FakeChat(rate=options.rate, count=options.count)
+    listen_server = await start_listen_server(options.host, options.listen_port, chat)
+    write_server = await start_write_server(options.host, options.write_port, chat)
+    logger.info('listen on %s:%s, write on %s:%s', options.host, options.listen_port,
+                options.host, options.write_port)
+    async with listen_server, write_server:
+        await asyncio.gather(listen_server.serve_forever(), write_server.serve_forever())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    parser = argparse.ArgumentParser(
+        prog='Fake chat server',
+        description='Local chat server for tests and benchmarks',
+    )
+
+    parser.add_argument('-host', '--host', type=str, default='127.0.0.1',
+                        help='host to serve')
+    parser.add_argument('-lp', '--listen_port', type=int, default=5000,
+                        help='port for chat listeners')
+    parser.add_argument('-wp', '--write_port', type=int, default=5050,
+                        help='port for chat writers')
+    parser.add_argument('-r', '--rate', type=float, default=0,
+                        help='generated messages per second for listener, '
+                             'inf is as fast as possible')
+    parser.add_argument('-c', '--count', type=int, default=0,
+                        help='close listener connection after count generated messages, '
+                             '0 is never')
+    parser.add_argument('-l', '--logging', action='store_true', default=False,
+                        help='is do logging')
+
+    args = parser.parse_args()
+
+    options = Options(**args.__dict__)
+
+    if not options.logging:
+        logging.disable()
+
+    try:
+        asyncio.run(main(options))
+    except KeyboardInterrupt:
+        pass
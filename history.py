@@ -0,0 +1,720 @@
+import array
+import asyncio
+from asyncio.exceptions import TimeoutError
+import bisect
+import datetime
+import gzip
+import io
+import json
+import logging
+import mmap
+import os
+from pathlib import Path
+import struct
+import time
+from typing import BinaryIO, Callable, Optional, Union
+
+import anyio
+from async_timeout import timeout
+
+from message import ChatMessage
+import metrics
+
+
+class HistoryArchive:
+    """
+    Closed segments of history file compressed by gzip and manifest of their time ranges.
+
+    History file itself is the active segment. On rotation it is compressed next to
+    itself as HISTORY_NAME.YYYYmmdd-HHMMSS.gz, segment is added to manifest
+    HISTORY_NAME.manifest.json and history file starts from scratch
+    """
+
+    def __init__(self, path: Path, compresslevel: int = 6):
+        self.path = path
+        self.manifest_path = path.with_name(path.name + '.manifest.json')
+        self.compresslevel = compresslevel
+
+    def load(self) -> dict:
+        try:
+            with open(self.manifest_path, encoding='UTF8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'active_started_at': None, 'segments': []}
+
+    def segments(self) -> list[dict]:
+        """Closed segments from the oldest to the newest"""
+        return self.load()['segments']
+
+    def segments_between(self, started_at: datetime.datetime,
+                         ended_at: datetime.datetime) -> list[dict]:
+        """Closed segments which have messages of the time range"""
+        return [
+            segment for segment in self.segments()
+            if datetime.datetime.fromisoformat(segment['started_at']) <= ended_at
+            and datetime.datetime.fromisoformat(segment['ended_at']) >= started_at
+        ]
+
+    def active_started_at(self) -> Optional[float]:
+        started_at = self.load()['active_started_at']
+        if not started_at:
+            return None
+        return datetime.datetime.fromisoformat(started_at).timestamp()
+
+    def set_active_started_at(self, started_at: float) -> None:
+        manifest = self.load()
+        manifest['active_started_at'] = self._format_time(started_at)
+        self._save(manifest)
+
+    def read_segment(self, segment: dict) -> bytes:
+        with gzip.open(self.path.with_name(segment['file']), 'rb') as f:
+            return f.read()
+
+    def archive_active(self, started_at: float, ended_at: float) -> dict:
+        """Compress history file to the new segment and remove it"""
+        segment_path = self._segment_path(started_at)
+        tmp_path = segment_path.with_name(segment_path.name + '.tmp')
+        lines_count = 0
+        size = 0
+        with open(self.path, 'rb') as src, open(tmp_path, 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb',
+                               compresslevel=self.compresslevel) as dst:
+                for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                    dst.write(chunk)
+                    lines_count += chunk.count(b'\n')
+                    size += len(chunk)
+            raw.flush()
+            # history file is removed below, so segment must be on disk
+            os.fsync(raw.fileno())
+        os.replace(tmp_path, segment_path)
+
+        segment = {
+            'file': segment_path.name,
+            'started_at': self._format_time(started_at),
+            'ended_at': self._format_time(ended_at),
+            'lines': lines_count,
+            'size': size,
+            'compressed_size': segment_path.stat().st_size,
+        }
+        manifest = self.load()
+        manifest['segments'].append(segment)
+        manifest['active_started_at'] = None
+        self._save(manifest)
+        os.remove(self.path)
+        return segment
+
+    def _save(self, manifest: dict) -> None:
+        tmp_path = self.manifest_path.with_name(self.manifest_path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='UTF8') as f:
+            json.dump(manifest, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path)
+
+    def _segment_path(self, started_at: float) -> Path:
+        stamp = datetime.datetime.fromtimestamp(started_at).strftime('%Y%m%d-%H%M%S')
+        segment_path = self.path.with_name(f'{self.path.name}.{stamp}.gz')
+        number = 1
+        while segment_path.exists():
+            segment_path = self.path.with_name(f'{self.path.name}.{stamp}-{number}.gz')
+            number += 1
+        return segment_path
+
+    @staticmethod
+    def _format_time(timestamp: float) -> str:
+        return datetime.datetime.fromtimestamp(timestamp).isoformat(timespec='seconds')
+
+
+class HistoryReader:
+    """
+    Read history from the end page by page.
+
+    Only the requested lines are read from disk, so the cost of a page
+    doesn't depend on the size of the whole file. With archive, pages continue
+    in closed segments from the newest to the oldest, a segment is decompressed
+    only when reading reaches it
+    """
+
+    def __init__(self, path: Path, chunk_size: int = 64 * 1024,
+                 archive: Optional[HistoryArchive] = None):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.archive = archive
+        # position of the first already read line in the current source,
+        # None until the first page
+        self.offset = None
+        # index of closed segment which is read, None is history file
+        self.source_index = None
+        self._segments = None
+        self._segment_data = None
+
+    @property
+    def exhausted(self) -> bool:
+        return self.offset == 0 and not self._has_older_source()
+
+    def read_previous(self, count: int) -> list[str]:
+        """Return up to count lines which are before already read lines"""
+        if self._segments is None:
+            self._segments = self.archive.segments() if self.archive is not None else []
+        self._follow_rotation()
+
+        lines = self._read_previous_in_source(count)
+        while len(lines) < count and self.offset == 0 and self._has_older_source():
+            self._open_source(len(self._segments) - 1 if self.source_index is None
+                              else self.source_index - 1)
+            lines = self._read_previous_in_source(count - len(lines)) + lines
+        return lines
+
+    def skip(self, count: int) -> int:
+        """
+        Forget count of the oldest read lines, the next page returns them again.
+
+        Lines after the first page can be skipped too, if they are written already.
+        Return count of skipped lines, it is less than count at the end of history file
+        """
+        if count <= 0 or self.offset is None:
+            return 0
+
+        self._follow_rotation()
+        skipped_count = 0
+        while True:
+            with self._open() as f:
+                f.seek(self.offset)
+                while skipped_count < count:
+                    line = f.readline()
+                    # the last line of history file can be written partially yet
+                    if not line or (not line.endswith(b'\n')
+                                    and self.source_index is None):
+                        break
+                    skipped_count += 1
+                    self.offset += len(line)
+
+            if skipped_count == count or self.source_index is None:
+                return skipped_count
+            # the rest of lines are in the newer source
+            newer_index = self.source_index + 1
+            self._open_source(newer_index if newer_index < len(self._segments) else None)
+            self.offset = 0
+
+    def _has_older_source(self) -> bool:
+        if self._segments is None:
+            return False
+        if self.source_index is None:
+            return bool(self._segments)
+        return self.source_index > 0
+
+    def _open_source(self, index: Optional[int]) -> None:
+        self.source_index = index
+        self.offset = None
+        self._segment_data = None
+        if index is not None:
+            self._segment_data = self.archive.read_segment(self._segments[index])
+
+    def _follow_rotation(self) -> None:
+        """If history file is rotated after the first page, continue in its segment"""
+        if self.archive is None or self.source_index is not None or self.offset is None:
+            return
+        segments = self.archive.segments()
+        if len(segments) > len(self._segments):
+            offset = self.offset
+            rotated_index = len(self._segments)
+            self._segments = segments
+            self._open_source(rotated_index)
+            self.offset = offset
+
+    def _open(self) -> BinaryIO:
+        if self.source_index is None:
+            return open(self.path, 'rb')
+        return io.BytesIO(self._segment_data)
+
+    def _read_previous_in_source(self, count: int) -> list[str]:
+        if count <= 0 or self.offset == 0:
+            return []
+        if self.source_index is None and not self.path.exists():
+            self.offset = 0
+            return []
+
+        with self._open() as f:
+            if self.offset is None:
+                self.offset = f.seek(0, 2)
+
+            pos = self.offset
+            chunks = []
+            newlines_count = 0
+            # one more newline is needed to be sure that the first line is whole
+            while pos > 0 and newlines_count <= count:
+                step = min(self.chunk_size, pos)
+                pos -= step
+                f.seek(pos)
+                chunk = f.read(step)
+                chunks.append(chunk)
+                newlines_count += chunk.count(b'\n')
+
+        data = b''.join(reversed(chunks))
+        if not data:
+            return []
+
+        ends_with_newline = data.endswith(b'\n')
+        if ends_with_newline:
+            data = data[:-1]
+        lines = data.split(b'\n')
+        if pos > 0:
+            # first line is cut by the chunk border
+            lines = lines[1:]
+
+        lines = lines[-count:]
+        consumed = sum(len(line) + 1 for line in lines)
+        if not ends_with_newline:
+            consumed -= 1
+        self.offset -= consumed
+
+        return [line.decode('UTF8', errors='replace') for line in lines]
+
+
+class MappedHistoryReader:
+    """
+    Random access to history file by line number and by time.
+
+    File is memory mapped. Persisted index keeps offset and time of every step-th line,
+    so a line is found by binary search in index and scan of less than step lines.
+    refresh indexes only lines appended after the previous refresh, index is rebuilt
+    if history file is replaced by rotation or truncated.
+
+    Time of line is from its prefix, lines are expected in time order as sink writes them
+    """
+
+    HEADER = struct.Struct('<8sqqqqq')
+    CHECKPOINT = struct.Struct('<qq')
+    MAGIC = b'CHATIDX1'
+
+    def __init__(self, path: Path, index_path: Optional[Path] = None, step: int = 1000):
+        self.path = path
+        self.index_path = index_path or path.with_name(path.name + '.lines.idx')
+        self.step = step
+        self.timestamps = TimestampFormatter()
+
+        # offset and time of lines step * i
+        self._offsets = array.array('q')
+        self._times = array.array('q')
+        self._file_id = 0
+        self._indexed_size = 0
+        self._lines_count = 0
+        self._last_timestamp = -1
+        self._file = None
+        self._mmap = None
+
+        self._load_index()
+        self.refresh()
+
+    @property
+    def lines_count(self) -> int:
+        return self._lines_count
+
+    def refresh(self) -> int:
+        """Index appended lines, return count of them"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._unmap()
+            self._reset(0)
+            return 0
+
+        if stat.st_ino != self._file_id or stat.st_size < self._indexed_size:
+            self._reset(stat.st_ino)
+        self._map(stat.st_size)
+        if self._mmap is None:
+            return 0
+
+        # last line can be written right now, it will be indexed on next refresh
+        end = self._mmap.rfind(b'\n', self._indexed_size) + 1
+        if end <= self._indexed_size:
+            return 0
+
+        first_new_checkpoint = len(self._offsets)
+        pos = self._indexed_size
+        lines_count = self._lines_count
+        while pos < end:
+            if lines_count % self.step == 0:
+                timestamp, _ = self.timestamps.parse(self._mmap[pos:pos + 64])
+                if timestamp is not None:
+                    self._last_timestamp = max(self._last_timestamp, timestamp)
+                self._offsets.append(pos)
+                self._times.append(self._last_timestamp)
+            pos = self._mmap.find(b'\n', pos, end) + 1
+            lines_count += 1
+
+        new_lines_count = lines_count - self._lines_count
+        self._lines_count = lines_count
+        self._indexed_size = end
+        self._save_index(first_new_checkpoint)
+        return new_lines_count
+
+    def read_lines(self, start: int, count: int) -> list[str]:
+        """Return count lines from line number start"""
+        if start < 0 or start >= self._lines_count or count <= 0:
+            return []
+
+        pos = self._offsets[start // self.step]
+        for _ in range(start % self.step):
+            pos = self._mmap.find(b'\n', pos, self._indexed_size) + 1
+        return [line.decode('UTF8', errors='replace')
+                for _, line in zip(range(count), self._iter_lines(pos))]
+
+    def find_line(self, moment: datetime.datetime) -> int:
+        """Return number of the first line which is written at moment or later"""
+        timestamp = int(moment.timestamp())
+        # the last checkpoint before moment, lines of moment can be before the next one
+        checkpoint = max(bisect.bisect_left(self._times, timestamp) - 1, 0)
+        if checkpoint >= len(self._offsets):
+            return self._lines_count
+
+        line_number = checkpoint * self.step
+        for line in self._iter_lines(self._offsets[checkpoint]):
+            line_timestamp, _ = self.timestamps.parse(line)
+            if line_timestamp is not None and line_timestamp >= timestamp:
+                return line_number
+            line_number += 1
+        return line_number
+
+    def read_between(self, since: Optional[datetime.datetime] = None,
+                     until: Optional[datetime.datetime] = None) -> list[str]:
+        """Return lines which are written in the time range"""
+        start = self.find_line(since) if since is not None else 0
+        if start >= self._lines_count:
+            return []
+        until_timestamp = int(until.timestamp()) if until is not None else None
+
+        pos = self._offsets[start // self.step]
+        for _ in range(start % self.step):
+            pos = self._mmap.find(b'\n', pos, self._indexed_size) + 1
+
+        lines = []
+        for line in self._iter_lines(pos):
+            timestamp, _ = self.timestamps.parse(line)
+            if (until_timestamp is not None and timestamp is not None
+                    and timestamp > until_timestamp):
+                break
+            lines.append(line.decode('UTF8', errors='replace'))
+        return lines
+
+    def close(self) -> None:
+        self._unmap()
+
+    def _iter_lines(self, pos: int):
+        end = self._indexed_size
+        while pos < end:
+            line_end = self._mmap.find(b'\n', pos, end)
+            yield self._mmap[pos:line_end]
+            pos = line_end + 1
+
+    def _map(self, size: int) -> None:
+        if self._mmap is not None and len(self._mmap) == size:
+            return
+        self._unmap()
+        if not size:
+            return
+        self._file = open(self.path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+
+    def _unmap(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+        self._mmap = None
+        self._file = None
+
+    def _reset(self, file_id: int) -> None:
+        self._offsets = array.array('q')
+        self._times = array.array('q')
+        self._file_id = file_id
+        self._indexed_size = 0
+        self._lines_count = 0
+        self._last_timestamp = -1
+
+    def _load_index(self) -> None:
+        try:
+            data = self.index_path.read_bytes()
+        except FileNotFoundError:
+            return
+        if len(data) < self.HEADER.size:
+            return
+
+        magic, step, file_id, indexed_size, lines_count, last_timestamp = (
+            self.HEADER.unpack_from(data))
+        checkpoints = array.array('q', data[self.HEADER.size:])
+        if (magic != self.MAGIC or step != self.step
+                or len(checkpoints) != 2 * -(-lines_count // step)):
+            # index of other version or broken by crash, it is rebuilt
+            return
+
+        self._offsets = checkpoints[0::2]
+        self._times = checkpoints[1::2]
+        self._file_id = file_id
+        self._indexed_size = indexed_size
+        self._lines_count = lines_count
+        self._last_timestamp = last_timestamp
+
+    def _save_index(self, first_new_checkpoint: int) -> None:
+        """Write header and checkpoints from first_new_checkpoint, older are on disk"""
+        mode = 'r+b' if first_new_checkpoint and self.index_path.exists() else 'wb'
+        with open(self.index_path, mode) as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.step, self._file_id,
+                                     self._indexed_size, self._lines_count,
+                                     self._last_timestamp))
+            f.seek(self.HEADER.size + first_new_checkpoint * self.CHECKPOINT.size)
+            for offset, timestamp in zip(self._offsets[first_new_checkpoint:],
+                                         self._times[first_new_checkpoint:]):
+                f.write(self.CHECKPOINT.pack(offset, timestamp))
+            f.truncate()
+
+
+class TimestampFormatter:
+    """Format current time for history lines, format is recalculated once per minute"""
+
+    def __init__(self, fmt: str = '%d.%m.%y %H:%M'):
+        self.fmt = fmt
+        self._minute = None
+        self._prefix = b''
+        # lines of the same minute have the same prefix, so it is parsed once
+        self._parsed = {}
+
+    def prefix(self, timestamp: Optional[float] = None) -> bytes:
+        """Encoded prefix of history line with unix time, current time by default"""
+        if timestamp is None:
+            timestamp = time.time()
+        minute = int(timestamp // 60)
+        if minute != self._minute:
+            self._minute = minute
+            formatted = datetime.datetime.fromtimestamp(timestamp).strftime(self.fmt)
+            self._prefix = f'[{formatted}] '.encode()
+        return self._prefix
+
+    def parse(self, line: bytes) -> tuple[Optional[int], int]:
+        """Unix time and size of prefix of history line, None and 0 without prefix"""
+        if not line.startswith(b'['):
+            return None, 0
+        end = line.find(b'] ', 1, 64)
+        if end == -1:
+            return None, 0
+
+        formatted = line[1:end]
+        timestamp = self._parsed.get(formatted)
+        if timestamp is None:
+            try:
+                timestamp = int(datetime.datetime.strptime(
+                    formatted.decode(), self.fmt).timestamp())
+            except (ValueError, UnicodeDecodeError):
+                return None, 0
+            if len(self._parsed) >= 100000:
+                self._parsed.clear()
+            self._parsed[formatted] = timestamp
+        return timestamp, end + 2
+
+
+class HistorySink:
+    """
+    Write messages from queue to history file in batches.
+
+    Batch is flushed when it has flush_size messages, when the oldest message in it
+    waits flush_interval seconds or on shutdown. Every flush is one thread round trip.
+    With fsync every flush is also synced to disk.
+
+    Queue items are chat messages, strings or bytes blocks of many messages separated
+    by newline. Chat messages are written without decoding with time of their receiving,
+    other items with current time.
+
+    On process crash messages of the batch and messages waiting in the queue are lost,
+    max_messages_lost_on_crash is the bound of them and messages_at_risk is the count
+    of the batch. On OS crash without fsync also everything in OS cache is lost.
+
+    History file is rotated to the compressed segment of archive when it grows
+    to rotate_size bytes or, with rotate_daily, on the first write of a new day.
+    Rotation runs in writing thread, so it doesn't block event loop.
+    """
+
+    def __init__(self, path: Path, *, flush_size: int = 100, flush_interval: float = 1.0,
+                 fsync: bool = False, rotate_size: int = 0, rotate_daily: bool = False):
+        self.path = path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.rotate_size = rotate_size
+        self.rotate_daily = rotate_daily
+        self.archive = HistoryArchive(path) if rotate_size or rotate_daily else None
+        self.timestamps = TimestampFormatter()
+        self.logger = logging.getLogger('history')
+
+        self._file = None
+        self._segment_started_at = None
+
+        history = str(path)
+        self.flush_seconds = metrics.histogram(
+            'chat_history_flush_seconds', 'Time of write of batch in history file',
+            history=history)
+        self.flushed_messages = metrics.counter(
+            'chat_history_flushed_messages_total', 'Messages written in history file',
+            history=history)
+        metrics.gauge('chat_history_messages_at_risk',
+                      'Accepted messages not in history file yet',
+                      lambda: self.messages_at_risk, history=history)
+        self.write_delay_seconds = metrics.histogram(
+            'chat_history_write_delay_seconds',
+            'Time from receiving of the oldest message in batch till its writing',
+            history=history)
+
+        # parts of lines, they are joined only by writing
+        self._buffer = []
+        self._buffered_count = 0
+        self._oldest_received_at = None
+        self._clock_offset = 0.0
+        # batch passed to writing thread, it is empty when thread has written it
+        self._writing_batch = []
+        self._writing_count = 0
+        self._unsynced_count = 0
+        self._queue = None
+        self._has_blocks = False
+
+    @property
+    def max_messages_lost_on_crash(self) -> Optional[int]:
+        """
+        Bound of messages lost on process crash, None if it is unknown.
+
+        Queue of the running sink holds up to its maxsize messages before the batch.
+        Batch holds up to flush_size messages, more only if writing failed.
+        Count of lines in blocks is unknown, so the bound is unknown with them too
+        """
+        if self._queue is None or self._queue.maxsize <= 0 or self._has_blocks:
+            return None
+        return self._queue.maxsize + max(self.flush_size, self.messages_at_risk)
+
+    @property
+    def messages_at_risk(self) -> int:
+        """Count of accepted messages which are not in the file yet"""
+        return self._buffered_count + self._writing_count
+
+    @property
+    def messages_not_synced(self) -> int:
+        """Count of written messages which can be lost on OS crash"""
+        return self._unsynced_count
+
+    def add(self, message: Union[ChatMessage, str, bytes]) -> None:
+        if isinstance(message, ChatMessage):
+            if self._oldest_received_at is None:
+                self._oldest_received_at = message.received_at
+                # wall clock of monotonic time is calculated once per batch
+                self._clock_offset = time.time() - time.monotonic()
+            # raw line is referenced, not copied, until batch is written
+            received_time = message.received_at + self._clock_offset
+            self._buffer += (self.timestamps.prefix(received_time), message.raw, b'\n')
+            self._buffered_count += 1
+            return
+
+        prefix = self.timestamps.prefix()
+        if isinstance(message, str):
+            self._buffer.append(prefix + message.encode() + b'\n')
+            self._buffered_count += 1
+            return
+
+        self._buffer.append(prefix + message.replace(b'\n', b'\n' + prefix) + b'\n')
+        self._buffered_count += message.count(b'\n') + 1
+        self._has_blocks = True
+
+    async def run(self, queue: asyncio.Queue,
+                  on_written: Optional[Callable[[], None]] = None) -> None:
+        """Write messages of queue by batches, on_written is called after every batch"""
+        self._queue = queue
+        self._open()
+        try:
+            while True:
+                self.add(await queue.get())
+                deadline = time.monotonic() + self.flush_interval
+                while self._buffered_count < self.flush_size:
+                    try:
+                        self.add(queue.get_nowait())
+                        continue
+                    except asyncio.QueueEmpty:
+                        pass
+                    wait_seconds = deadline - time.monotonic()
+                    if wait_seconds <= 0:
+                        break
+                    try:
+                        async with timeout(wait_seconds):
+                            self.add(await queue.get())
+                    except TimeoutError:
+                        break
+
+                # batch is not empty if previous writing failed
+                self._take_buffer()
+                await anyio.to_thread.run_sync(self._write)
+                if on_written is not None:
+                    on_written()
+        finally:
+            # shutdown: write synchronously, awaiting is impossible in cancelled task
+            while not queue.empty():
+                self.add(queue.get_nowait())
+            self._take_buffer()
+            if self._writing_batch:
+                self.logger.debug('flush %s messages on shutdown', self._writing_count)
+                self._write()
+            self._file.close()
+
+    def _open(self) -> None:
+        self._file = open(self.path, 'ab')
+        if self.archive is not None and self._segment_started_at is None:
+            self._segment_started_at = self.archive.active_started_at()
+            if self._segment_started_at is None and self._file.tell():
+                # history file is older than rotation, its last write is the best guess
+                self._segment_started_at = os.path.getmtime(self.path)
+
+    def _take_buffer(self) -> None:
+        if self._oldest_received_at is not None:
+            self.write_delay_seconds.observe(time.monotonic() - self._oldest_received_at)
+            self._oldest_received_at = None
+        self._writing_batch += self._buffer
+        self._writing_count += self._buffered_count
+        self._buffer = []
+        self._buffered_count = 0
+
+    def _write(self) -> None:
+        if self._is_day_over():
+            self._rotate()
+        if self.archive is not None and self._segment_started_at is None:
+            self._segment_started_at = time.time()
+            self.archive.set_active_started_at(self._segment_started_at)
+
+        started_at = time.perf_counter()
+        f = self._file
+        f.write(b''.join(self._writing_batch))
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+            self._unsynced_count = 0
+        else:
+            self._unsynced_count += self._writing_count
+        self.flush_seconds.observe(time.perf_counter() - started_at)
+        self.flushed_messages.inc(self._writing_count)
+        self._writing_batch = []
+        self._writing_count = 0
+
+        if self.rotate_size and f.tell() >= self.rotate_size:
+            self._rotate()
+
+    def _is_day_over(self) -> bool:
+        if (not self.rotate_daily or self._segment_started_at is None
+                or not self._file.tell()):
+            return False
+        started_on = datetime.date.fromtimestamp(self._segment_started_at)
+        return started_on != datetime.date.today()
+
+    def _rotate(self) -> None:
+        self._file.close()
+        try:
+            segment = self.archive.archive_active(self._segment_started_at or time.time(),
+                                                  time.time())
+        except OSError:
+            # history is still written in the same file, rotation is retried later
+            self.logger.exception('history rotation is failed')
+        else:
+            self.logger.debug('history is rotated to %s', segment['file'])
+            self._segment_started_at = None
+        self._file = open(self.path, 'ab')
@@ -0,0 +1,70 @@
+import logging
+import time
+from typing import Callable, Optional
+
+import anyio
+
+
+class LivenessMonitor:
+    """
+    Watch that connection is alive: any inbound traffic is a proof of life.
+
+    If connection is silent for keepalive_interval seconds, keepalive is sent, its round
+    trip time is measured by the first inbound traffic after it. If connection is silent
+    for timeout seconds, watch raises ConnectionError
+    """
+
+    def __init__(self, name: str, timeout: float = 10.0, keepalive_interval: float = 5.0,
+                 logger: Optional[logging.Logger] = None):
+        self.name = name
+        self.timeout = timeout
+        self.keepalive_interval = keepalive_interval
+        self.logger = logger or logging.getLogger('watchdog')
+
+        self.last_seen = time.monotonic()
+        self.last_rtt = None
+        self.average_rtt = None
+        self._keepalive_requested = False
+        self._keepalive_sent_at = None
+
+    def reset(self) -> None:
+        """Call when connection is established"""
+        self.last_seen = time.monotonic()
+        self._keepalive_requested = False
+        self._keepalive_sent_at = None
+
+    def touch(self) -> None:
+        """Call on any inbound traffic"""
+        self.last_seen = time.monotonic()
+        if self._keepalive_sent_at is not None:
+            self.last_rtt = self.last_seen - self._keepalive_sent_at
+            if self.average_rtt is None:
+                self.average_rtt = self.last_rtt
+            else:
+                self.average_rtt = 0.8 * self.average_rtt + 0.2 * self.last_rtt
+            self.logger.debug('%s: keepalive RTT %.3fs', self.name, self.last_rtt)
+        self._keepalive_requested = False
+        self._keepalive_sent_at = None
+
+    def keepalive_sent(self) -> None:
+        """Call when keepalive is written in connection"""
+        self._keepalive_sent_at = time.monotonic()
+
+    async def watch(self, send_keepalive: Optional[Callable[[], None]] = None) -> None:
+        """Sleep while connection is alive, without send_keepalive it is never sent"""
+        while True:
+            silence = time.monotonic() - self.last_seen
+            if silence >= self.timeout:
+                self.logger.warning(f'{self.name}: {self.timeout}s timeout is elapsed')
+                raise ConnectionError(
+                    f'{self.name} connection is silent for {silence:.1f}s')
+
+            wake_at = self.timeout
+            if send_keepalive is not None and not self._keepalive_requested:
+                if silence >= self.keepalive_interval:
+                    self._keepalive_requested = True
+                    send_keepalive()
+                else:
+                    wake_at = self.keepalive_interval
+
+            await anyio.sleep(wake_at - silence)
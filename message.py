@@ -0,0 +1,60 @@
+import time
+
+
+class ChatMessage:
+    """
+    Message received from chat.
+
+    Raw line is kept without decoding, its text is decoded on the first access and cached,
+    author is parsed from the text once too, only size of author is kept, so it costs
+    nothing for usual nicknames. Only monotonic receive time is kept, wall clock receive
+    time is calculated from it, so record is smaller.
+
+    Record is still larger than str of the same line, see README
+    """
+
+    __slots__ = ('raw', 'received_at', '_line', '_author_size')
+
+    def __init__(self, raw: bytes, received_at: float):
+        self.raw = raw
+        self.received_at = received_at
+        self._line = None
+        # None until line is parsed, -1 for line without author
+        self._author_size = None
+
+    @classmethod
+    def from_line(cls, line: bytes) -> 'ChatMessage':
+        """Message from line which is just read from connection"""
+        return cls(line.strip(), time.monotonic())
+
+    @property
+    def received_time(self) -> float:
+        """Unix time of receiving"""
+        return self.received_at + time.time() - time.monotonic()
+
+    @property
+    def line(self) -> str:
+        if self._line is None:
+            self._line = self.raw.decode(errors='replace')
+        return self._line
+
+    @property
+    def author(self) -> str:
+        author_size = self._parse()
+        return self.line[:author_size] if author_size >= 0 else ''
+
+    @property
+    def text(self) -> str:
+        author_size = self._parse()
+        return self.line[author_size + 2:] if author_size >= 0 else self.line
+
+    def _parse(self) -> int:
+        if self._author_size is None:
+            self._author_size = self.line.find(': ')
+        return self._author_size
+
+    def __str__(self):
+        return self.line
+
+    def __repr__(self):
+        return f'ChatMessage({self.raw!r})'
@@ -1,29 +1,58 @@
 import asyncio
-from asyncio.exceptions import TimeoutError
 import argparse
-import datetime
+import io
 import json
 from dataclasses import dataclass
+from enum import Enum
 import logging
 from pathlib import Path
+import time
 from tkinter import messagebox, TclError
-from typing import Any
+from typing import Any, Optional
 
 import anyio
-import aiofiles
-from async_timeout import timeout
 
 import messenger_gui as gui
-from context_managers import open_connection, open_connection_queue
+import metrics
+from context_managers import open_connection_queue
+from dedup import RecentMessages
+from history import HistoryArchive, HistoryReader, HistorySink
+from liveness import LivenessMonitor
+from message import ChatMessage
+from queues import BoundedQueue, OverflowPolicy, SendScheduler
+from reconnect import CircuitState, ReconnectPolicy
+from search import SearchIndex, SearchResult
+from tk_display import TkAppClosed
+
+
+class InvalidTokenError(Exception):
+    pass
 
 
 class Messenger:
     def __init__(self, *, messages_queue: asyncio.Queue, sending_queue: asyncio.Queue,
                  status_updates_queue: asyncio.Queue, listen_host: str, listen_port: int,
-                 history_path: Path, write_host: str, write_port: int, token: str):
+                 history_path: Path, write_host: str, write_port: int, token: str,
+                 history_page_size: int = 1000, flush_size: int = 100,
+                 flush_interval: float = 1.0, fsync: bool = False,
+                 keepalive_interval: float = 5.0, send_timeout: float = 10.0,
+                 read_timeout: float = 0, queue_size: int = 10000,
+                 rotate_size: int = 0, rotate_daily: bool = False,
+                 search_index: bool = False, dedup_size: int = 10000):
         self.listen_host = listen_host
         self.listen_port = listen_port
         self.history_path = history_path
+        self.history_page_size = history_page_size
+        # older pages continue in rotated segments of history
+        self.history_reader = HistoryReader(
+            history_path, archive=HistoryArchive(history_path))
+        self.history_sink = HistorySink(
+            history_path, flush_size=flush_size, flush_interval=flush_interval,
+            fsync=fsync, rotate_size=rotate_size * 1024 * 1024, rotate_daily=rotate_daily)
+        self.search_index = SearchIndex(history_path) if search_index else None
+        # chat replays recent messages on every connection, they are already in history
+        self.recent_messages = RecentMessages(dedup_size)
+        self.recent_messages.seed_from_history(history_path)
         self.write_host = write_host
         self.write_port = write_port
         self.token = token
@@ -37,16 +66,152 @@ class Messenger:
         self.messages_queue = messages_queue
         self.sending_queue = sending_queue
         self.status_updates_queue = status_updates_queue
-        self.messages_to_file_queue = asyncio.Queue()
-        self.watchdog_queue = asyncio.Queue()
-
+        # reading waits for saving, so history doesn't lose messages
+        self.messages_to_file_queue = BoundedQueue(queue_size, OverflowPolicy.BLOCK)
+
+        # quiet chat is silent for long, so silence of reading connection is not a sign
+        # of its death by default, reconnect would only make chat replay recent messages
+        self.read_liveness = LivenessMonitor(
+            'read', timeout=read_timeout, logger=self.watchdog_logger)
+        self.send_liveness = LivenessMonitor(
+            'send', timeout=send_timeout, keepalive_interval=keepalive_interval,
+            logger=self.watchdog_logger)
+
+        self.read_reconnect_policy = ReconnectPolicy()
+        self.send_reconnect_policy = ReconnectPolicy()
+        self.save_restart_policy = ReconnectPolicy()
+
+        self._init_metrics()
         self._read_history_messages()
 
+    def _init_metrics(self) -> None:
+        self.received_messages = metrics.counter(
+            'chat_received_messages_total', 'Messages received from chat')
+        self.received_bytes = metrics.counter(
+            'chat_received_bytes_total', 'Bytes of messages received from chat')
+        self.sent_messages = metrics.counter(
+            'chat_sent_messages_total', 'Messages sent in chat')
+        self.sent_bytes = metrics.counter(
+            'chat_sent_bytes_total', 'Bytes sent in chat with keepalives')
+        self.handshake_seconds = metrics.histogram(
+            'chat_handshake_seconds', 'Time of greeting and authorization')
+        metrics.counter('chat_replayed_messages_total',
+                        'Messages dropped as replay after connection',
+                        lambda: self.recent_messages.dropped_count)
+
+        # values of queues and liveness are read only on export
+        queues = {
+            'messages': self.messages_queue,
+            'sending': self.sending_queue,
+            'status_updates': self.status_updates_queue,
+            'messages_to_file': self.messages_to_file_queue,
+        }
+        for name, queue in queues.items():
+            metrics.gauge('chat_queue_size', 'Count of items in queue', queue.qsize,
+                          queue=name)
+            if isinstance(queue, BoundedQueue):
+                metrics.counter('chat_queue_dropped_total', 'Items dropped by full queue',
+                                lambda queue=queue: queue.dropped_count, queue=name)
+            if isinstance(queue, SendScheduler):
+                metrics.counter('chat_queue_coalesced_total',
+                                'Keepalives coalesced in queue',
+                                lambda queue=queue: queue.coalesced_count, queue=name)
+        metrics.gauge('chat_keepalive_rtt_seconds',
+                      'Average round trip time of keepalive',
+                      lambda: self.send_liveness.average_rtt)
+
     def _read_history_messages(self) -> None:
-        """Call only once on init to read all saved messages"""
-        with open(self.history_path, 'r', encoding='UTF8') as f:
-            for message in f:
-                self.messages_queue.put_nowait(message.strip())
+        """
+        Call only once on init to read last saved messages, older are loaded later.
+
+        The page is read before anything is received, so it ends where messages
+        of this run start in history file. GUI takes it as the first older page
+        """
+        self._first_history_page = None
+        # received messages which are saved before the oldest shown one,
+        # and how many of them are not skipped by history reader yet
+        self._forgotten_saved_count = 0
+        self._not_skipped_count = 0
+        # count of segments and size of history file where messages of this run start,
+        # lines before them are counted only when they are needed
+        segments = self.history_reader.archive.segments()
+        size = self.history_path.stat().st_size if self.history_path.exists() else 0
+        self._history_start = (len(segments), size)
+        self._history_start_id = None
+        self._first_history_page = self.load_older_history_messages()
+
+    def load_older_history_messages(self) -> Optional[list[str]]:
+        """
+        Return next page of saved messages which are older than already loaded.
+
+        None is returned if messages before the oldest shown one are not saved yet,
+        the page can be requested again later
+        """
+        if self._first_history_page is not None:
+            messages, self._first_history_page = self._first_history_page, None
+            return messages
+
+        if self._not_skipped_count:
+            self._not_skipped_count -= self.history_reader.skip(self._not_skipped_count)
+            if self._not_skipped_count:
+                return None
+        messages = self.history_reader.read_previous(self.history_page_size)
+        return [message.strip() for message in messages]
+
+    def forget_history_messages(self, count: int,
+                                saved_count: Optional[int] = None) -> None:
+        """
+        Call when the oldest shown messages are not shown anymore.
+
+        count is of lines of history pages. If received messages are not shown too,
+        saved_count is count of received messages which are saved before the oldest
+        shown one, including not shown in GUI. History reader skips them in file,
+        not yet saved ones are skipped when they are written
+        """
+        self.history_reader.skip(count)
+        if saved_count is None or saved_count <= self._forgotten_saved_count:
+            return
+
+        self._not_skipped_count += saved_count - self._forgotten_saved_count
+        self._forgotten_saved_count = saved_count
+        self._not_skipped_count -= self.history_reader.skip(self._not_skipped_count)
+
+    def search_history_messages(self, query: str) -> list[SearchResult]:
+        """Return the newest saved messages with query substring"""
+        return self.search_index.search(query)
+
+    def get_history_start_id(self) -> int:
+        """
+        Return search index id of the last message saved before this run.
+
+        Received message of this run with saved number n has id of it plus n.
+        Lines of history are counted on the first call, segments by their manifest
+        """
+        if self._history_start_id is not None:
+            return self._history_start_id
+
+        segments_count, size = self._history_start
+        archive = self.history_reader.archive
+        segments = archive.segments()
+        lines_count = sum(segment['lines'] for segment in segments[:segments_count])
+        if not size:
+            f = io.BytesIO()
+        elif len(segments) > segments_count:
+            # history file is rotated after start
+            f = io.BytesIO(archive.read_segment(segments[segments_count]))
+        else:
+            f = open(self.history_path, 'rb')
+        with f:
+            while size > 0:
+                chunk = f.read(min(size, 1024 * 1024))
+                if not chunk:
+                    break
+                # partial last line is continued by the first received message
+                lines_count += chunk.count(b'\n')
+                size -= len(chunk)
+
+        self._history_start_id = lines_count
+        return lines_count
 
     async def read_msgs(self) -> None:
         async with open_connection_queue(
@@ -57,22 +222,50 @@ class Messenger:
                 gui.ReadConnectionStateChanged.ESTABLISHED,
                 gui.ReadConnectionStateChanged.CLOSED
         ) as (reader, writer):
-            self.watchdog_queue.put_nowait('Connection established')
+            self.read_reconnect_policy.record_connected()
+            self.read_liveness.reset()
+            self.recent_messages.resume()
             while not reader.at_eof():
-                message = await reader.readline()
-                message = message.decode().strip()
-                self.logger.debug(f'RECEIVE: {message}')
+                line = await reader.readline()
+                if not line:
+                    break
+                self.read_liveness.touch()
+                self.received_messages.inc()
+                self.received_bytes.inc(len(line))
+                # the same record goes to history and GUI, text is decoded once if needed
+                message = ChatMessage.from_line(line)
+                self.logger.debug('RECEIVE: %s', message)
+                if not self.recent_messages.accept(message):
+                    continue
+                # chat replays recent messages even if it drops connection right after,
+                # so only a new message proves that connection is healthy
+                self.read_reconnect_policy.record_success()
+                await self.messages_to_file_queue.put(message)
                 self.messages_queue.put_nowait(message)
-                self.messages_to_file_queue.put_nowait(message)
-                self.watchdog_queue.put_nowait('New message in chat')
+
+    async def listen_msgs(self) -> None:
+        """Read messages while liveness monitor sees that connection is alive"""
+        if not self.read_liveness.timeout:
+            await self.read_msgs()
+            return
+
+        async with anyio.create_task_group() as tg:
+            tg.start_soon(self.read_liveness.watch)
+            await self.read_msgs()
+            tg.cancel_scope.cancel()
 
     async def save_msgs(self) -> None:
-        async with aiofiles.open(self.history_path, 'a', encoding='UTF8') as f:
-            while True:
-                message = await self.messages_to_file_queue.get()
-                formatted_now = datetime.datetime.now().strftime('%d.%m.%y %H:%M')
-                message = f'[{formatted_now}] {message}\n'
-                await f.write(message)
+        # saving is healthy again when a batch is written after restart
+        on_written = self.save_restart_policy.record_success
+        if self.search_index is None:
+            await self.history_sink.run(self.messages_to_file_queue, on_written)
+            return
+
+        # index reads history file after sink, so it never slows down receiving
+        async with anyio.create_task_group() as tg:
+            tg.start_soon(self.search_index.run)
+            await self.history_sink.run(self.messages_to_file_queue, on_written)
+            tg.cancel_scope.cancel()
 
     async def send_msgs(self) -> None:
         async with open_connection_queue(
@@ -83,21 +276,49 @@ class Messenger:
                 gui.SendingConnectionStateChanged.ESTABLISHED,
                 gui.SendingConnectionStateChanged.CLOSED,
         ) as (reader, writer):
-            await self.get_creds_after_authorization(reader, writer)
-
-            while True:
-                message = await self.sending_queue.get()
-                # double \n because chat require empty string for message sending
-                await self.write_message_in_stream(writer, f'{message}\n\n')
+            self.logger.info('authorization...')
+            started_at = time.perf_counter()
+            creds = await self.get_creds_after_authorization(reader, writer)
+            self.handshake_seconds.observe(time.perf_counter() - started_at)
+            self.check_token_for_authorization(creds)
+            self.send_reconnect_policy.record_connected()
+            self.send_liveness.reset()
+
+            async with anyio.create_task_group() as tg:
+                tg.start_soon(self.send_liveness.watch, self.request_keepalive)
+                tg.start_soon(self.read_sending_replies, reader)
+
+                while True:
+                    message = await self.sending_queue.get()
+                    # double \n because chat require empty string for message sending
+                    await self.write_message_in_stream(writer, f'{message}\n\n')
+
+                    if message:
+                        self.sent_messages.inc()
+                        self.logger.info('message submitted')
+                    else:
+                        self.send_liveness.keepalive_sent()
+
+    async def read_sending_replies(self, reader: asyncio.StreamReader) -> None:
+        """Replies of chat on sent messages are proof of life of sending connection"""
+        while True:
+            reply = await reader.readline()
+            if not reply:
+                raise ConnectionError('sending connection is closed by chat')
+            self.send_liveness.touch()
+            # reply on message or keepalive proves that connection is healthy
+            self.send_reconnect_policy.record_success()
+            self.logger.debug('RECEIVE: %s', reply.decode().strip())
 
-                self.logger.info('message submitted')
-                self.watchdog_queue.put_nowait('Message sent')
+    def request_keepalive(self) -> None:
+        self.sending_queue.put_nowait('')  # ping pong
 
     async def write_message_in_stream(self, writer: asyncio.StreamWriter, text: str) -> None:
         """Wrapper of stream message sending"""
         text = text.encode()
         self.logger.debug(f'SEND: {text}')
         writer.write(text)
+        self.sent_bytes.inc(len(text))
         await writer.drain()
 
     async def get_creds_after_authorization(
@@ -117,53 +338,63 @@ class Messenger:
 
         return creds
 
-    async def check_token_for_authorization(self) -> bool:
-        """
-        Check in authorization if token right
-
-        Return bool value of authorization result
-        """
-        self.logger.info('authorization...')
-        async with open_connection(self.write_host, self.write_port) as (reader, writer):
-            creds = await self.get_creds_after_authorization(reader, writer)
-
-            if not creds:
-                self.logger.error(f'Wrong token {self.token}')
-                messagebox.showinfo("Неверный токен", "Проверьте токен, сервер его не узнал")
-                return False
+    def check_token_for_authorization(self, creds: dict[str, Any]) -> None:
+        """Check in authorization result if token right, raise InvalidTokenError if not"""
+        if not creds:
+            self.logger.error(f'Wrong token {self.token}')
+            messagebox.showinfo("Неверный токен", "Проверьте токен, сервер его не узнал")
+            raise InvalidTokenError(self.token)
 
         self.status_updates_queue.put_nowait(gui.NicknameReceived(creds['nickname']))
         self.logger.info('success authorization')
-        return True
 
-    async def watch_for_connection(self) -> None:
-        timeout_seconds = 10
-        while True:
-            try:
-                send_empty_message_every_seconds = 5
-                async with timeout(timeout_seconds):
-                    message = await self.watchdog_queue.get()
-                    self.watchdog_logger.debug(f'Connection is alive. {message}')
-                    self.sending_queue.put_nowait('')  # ping pong
-                    await anyio.sleep(send_empty_message_every_seconds)
-            except TimeoutError:
-                self.watchdog_logger.warning(f'{timeout_seconds}s timeout is elapsed')
-                raise ConnectionError
+    async def supervise(self, run_subsystem, restart_policy: ReconnectPolicy,
+                        state_type: Optional[type[Enum]] = None) -> None:
+        """
+        Run subsystem coroutine and restart it by its policy when it stops.
 
-    async def handle_connection(self) -> None:
-        """Function run all coruutines and try to reconnect if connection lost"""
-        try_reconnect_every_seconds = 1
+        Delay before restart of connection with state_type is shown in GUI
+        """
+        name = run_subsystem.__name__
         while True:
+            restart_policy.attempt()
             try:
-                async with anyio.create_task_group() as tg:
-                    tg.start_soon(self.check_token_for_authorization)
-                    tg.start_soon(self.read_msgs)
-                    tg.start_soon(self.save_msgs)
-                    tg.start_soon(self.send_msgs)
-                    tg.start_soon(self.watch_for_connection)
+                await run_subsystem()
+                self.watchdog_logger.warning(f'{name} is stopped')
+            except anyio.get_cancelled_exc_class():
+                raise
+            except InvalidTokenError:
+                # there is no sense to restart with the same token,
+                # only sending connection is authorized, so its state shows the reason
+                self.status_updates_queue.put_nowait(
+                    gui.SendingConnectionStateChanged.TOKEN_REJECTED)
+                return
             except BaseException:
-                self.watchdog_logger.warning('Connection error happened')
-                await anyio.sleep(try_reconnect_every_seconds)
+                self.watchdog_logger.warning(f'{name}: error happened')
+
+            metrics.counter('chat_restarts_total', 'Restarts of subsystem',
+                            subsystem=name).inc()
+            delay = restart_policy.next_delay()
+            self.watchdog_logger.warning(f'Restart {name} in {delay:.1f}s')
+            if state_type is not None:
+                is_circuit_open = restart_policy.state is CircuitState.OPEN
+                self.status_updates_queue.put_nowait(
+                    gui.ReconnectScheduled(state_type, delay, is_circuit_open))
+            await anyio.sleep(delay)
+
+    async def handle_connection(self) -> None:
+        """
+        Function run listening, sending and saving of messages.
+
+        Every subsystem is restarted independently, so sending failure doesn't
+        interrupt reading, and history file stays open while connections are restarted
+        """
+        async with anyio.create_task_group() as tg:
+            tg.start_soon(self.supervise, self.save_msgs, self.save_restart_policy)
+            tg.start_soon(self.supervise, self.listen_msgs, self.read_reconnect_policy,
+                          gui.ReadConnectionStateChanged)
+            tg.start_soon(self.supervise, self.send_msgs, self.send_reconnect_policy,
+                          gui.SendingConnectionStateChanged)
 
 
 @dataclass
@@ -174,6 +405,23 @@ class Options:
     write_host: str
     write_port: int
     token: str
+    history_page_size: int
+    flush_size: int
+    flush_interval: float
+    fsync: bool
+    keepalive_interval: float
+    send_timeout: float
+    read_timeout: float
+    queue_size: int
+    send_rate: float
+    send_burst: int
+    rotate_size: int
+    rotate_daily: bool
+    search_index: bool
+    dedup_size: int
+    metrics_port: Optional[int]
+    metrics_path: Optional[Path]
+    metrics_interval: float
 
 
 async def main():
@@ -190,25 +438,83 @@ async def main():
     parser.add_argument('-wh', '--write_host', type=str, required=True, help='host of chat to write')
     parser.add_argument('-wp', '--write_port', type=int, required=True, help='port of chat to write')
     parser.add_argument('-t', '--token', type=str, required=True, help='token of registered user')
+    parser.add_argument('-hs', '--history_page_size', type=int, default=1000,
+                        help='count of history messages loaded on start '
+                             'and on scroll to top')
+    parser.add_argument('-fs', '--flush_size', type=int, default=100,
+                        help='count of messages to write in history file at once')
+    parser.add_argument('-fi', '--flush_interval', type=float, default=1.0,
+                        help='max seconds which message waits '
+                             'before writing in history file')
+    parser.add_argument('--fsync', action='store_true', default=False,
+                        help='sync history file to disk after every write')
+    parser.add_argument('-ki', '--keepalive_interval', type=float, default=5.0,
+                        help='seconds of sending connection silence before keepalive')
+    parser.add_argument('-st', '--send_timeout', type=float, default=10.0,
+                        help='seconds of sending connection silence before reconnect')
+    parser.add_argument('-rt', '--read_timeout', type=float, default=0,
+                        help='seconds without messages in chat before reconnect, '
+                             '0 is never')
+    parser.add_argument('-qs', '--queue_size', type=int, default=10000,
+                        help='max count of received messages '
+                             'waiting for GUI or history file')
+    parser.add_argument('-sr', '--send_rate', type=float, default=0,
+                        help='max messages per second sent in chat, 0 is no limit')
+    parser.add_argument('-sb', '--send_burst', type=int, default=10,
+                        help='count of messages which can be sent at once '
+                             'under send rate')
+    parser.add_argument('-rs', '--rotate_size', type=int, default=0,
+                        help='megabytes of history file to compress it in archive, '
+                             '0 is never')
+    parser.add_argument('--rotate_daily', action='store_true', default=False,
+                        help='compress history file in archive every day')
+    parser.add_argument('--search_index', action='store_true', default=False,
+                        help='keep full-text search index of history and show search box')
+    parser.add_argument('-ds', '--dedup_size', type=int, default=10000,
+                        help='count of the last messages to drop their replay '
+                             'after reconnect, 0 is never')
+    parser.add_argument('--metrics_port', type=int, default=None,
+                        help='serve metrics in Prometheus format on localhost port')
+    parser.add_argument('--metrics_path', type=Path, default=None,
+                        help='dump metrics in json file every metrics interval')
+    parser.add_argument('--metrics_interval', type=float, default=10.0,
+                        help='seconds between dumps of metrics')
 
     args = parser.parse_args()
 
     options = Options(**args.__dict__)
-    messages_queue = asyncio.Queue()
-    sending_queue = asyncio.Queue()
-    status_updates_queue = asyncio.Queue()
-
+    if options.metrics_port is not None or options.metrics_path is not None:
+        metrics.enable()
+    # GUI shows only the last messages, all of them are in history file anyway
+    messages_queue = BoundedQueue(options.queue_size, OverflowPolicy.DROP_OLDEST)
+    # user messages are sent before keepalives, redundant keepalives are coalesced
+    sending_queue = SendScheduler(1000, options.send_rate, options.send_burst)
+    status_updates_queue = BoundedQueue(
+        100, OverflowPolicy.COALESCE, coalesce_key=gui.get_status_key)
+
+    # options of metrics and sending queue aren't options of messenger
+    messenger_options = {key: value for key, value in options.__dict__.items()
+                         if not key.startswith('metrics_')
+                         and key not in ('send_rate', 'send_burst')}
     messenger = Messenger(
         messages_queue=messages_queue, sending_queue=sending_queue,
-        status_updates_queue=status_updates_queue, **options.__dict__
+        status_updates_queue=status_updates_queue, **messenger_options
     )
     async with anyio.create_task_group() as tg:
-        tg.start_soon(gui.draw, messages_queue, sending_queue, status_updates_queue)
+        tg.start_soon(metrics.export, options.metrics_port, options.metrics_path,
+                      options.metrics_interval)
+        search_messages = None
+        if options.search_index:
+            search_messages = messenger.search_history_messages
+        tg.start_soon(gui.draw, messages_queue, sending_queue, status_updates_queue,
+                      messenger.load_older_history_messages,
+                      messenger.forget_history_messages, search_messages,
+                      messenger.get_history_start_id)
         tg.start_soon(messenger.handle_connection)
 
 
 if __name__ == '__main__':
     try:
         anyio.run(main)
-    except (KeyboardInterrupt, gui.TkAppClosed, TclError):
+    except (KeyboardInterrupt, TkAppClosed, TclError):
         pass
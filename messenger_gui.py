@@ -1,13 +1,13 @@
 import tkinter as tk
 import asyncio
+from bisect import bisect_left
+from collections import deque
 from tkinter.scrolledtext import ScrolledText
 from enum import Enum
 
 from anyio import create_task_group
 
-
-class TkAppClosed(Exception):
-    pass
+from tk_display import update_tk
 
 
 class ReadConnectionStateChanged(Enum):
@@ -23,45 +23,263 @@ class SendingConnectionStateChanged(Enum):
     INITIATED = 'устанавливаем соединение'
     ESTABLISHED = 'соединение установлено'
     CLOSED = 'соединение закрыто'
+    TOKEN_REJECTED = 'токен не принят, отправка остановлена'
 
     def __str__(self):
         return str(self.value)
 
 
+class ReconnectScheduled:
+    def __init__(self, state_type, delay, is_circuit_open):
+        self.state_type = state_type
+        self.delay = delay
+        self.is_circuit_open = is_circuit_open
+
+
 class NicknameReceived:
     def __init__(self, nickname):
         self.nickname = nickname
 
 
+def get_status_key(msg):
+    """Statuses with the same key are shown in the same label, so the last one matters"""
+    if isinstance(msg, ReconnectScheduled):
+        return msg.state_type
+    return type(msg)
+
+
 def process_new_message(input_field, sending_queue):
     text = input_field.get()
-    sending_queue.put_nowait(text)
+    try:
+        sending_queue.put_nowait(text)
+    except asyncio.QueueFull:
+        # text stays in the field, so user can send it later
+        return
     input_field.delete(0, tk.END)
 
 
-async def update_tk(root_frame, interval=1 / 120):
-    while True:
-        try:
-            root_frame.update()
-        except tk.TclError:
-            # if application has been destroyed/closed
-            raise TkAppClosed()
-        await asyncio.sleep(interval)
-
-
-async def update_conversation_history(panel, messages_queue):
+class PanelLines:
+    """
+    Origin of lines of conversation panel.
+
+    Lines of history pages are on the top of the panel, received messages are below.
+    Received message is known by its number among saved messages. It is counted from
+    messages which are taken from the queue and dropped by it, so the oldest shown
+    message is found in history file even if some messages weren't shown.
+
+    History lines end before the first received message or, after received ones
+    were evicted, at the last evicted one, history_end_number is its number
+    """
+
+    def __init__(self, messages_queue):
+        self.messages_queue = messages_queue
+        self.history_count = 0
+        self.history_end_number = 0
+        self.received_numbers = deque()
+        self._taken_count = 0
+
+    def add_received(self, count):
+        """Call right after count of messages is taken from the queue"""
+        # queue drops the oldest messages, so dropped ones are before taken ones
+        first_number = (self._taken_count + 1
+                        + getattr(self.messages_queue, 'dropped_count', 0))
+        self.received_numbers.extend(range(first_number, first_number + count))
+        self._taken_count += count
+
+    def evict(self, count):
+        """
+        Forget count of the oldest lines.
+
+        Return count of history lines among them and count of saved messages
+        before the oldest shown received one, None if no received message is evicted
+        """
+        history_count = min(count, self.history_count)
+        self.history_count -= history_count
+        saved_count = None
+        for _ in range(count - history_count):
+            saved_count = self.received_numbers.popleft()
+        if saved_count is not None:
+            # history reader skips to it, so older pages end there
+            self.history_end_number = saved_count
+        return history_count, saved_count
+
+    def find_line(self, number):
+        """Return panel line of saved message with number, 0 if it isn't in the panel"""
+        if number <= self.history_end_number:
+            return max(self.history_count - (self.history_end_number - number), 0)
+        position = bisect_left(self.received_numbers, number)
+        if (position == len(self.received_numbers)
+                or self.received_numbers[position] != number):
+            return 0
+        return self.history_count + position + 1
+
+
+async def update_conversation_history(panel, messages_queue, max_lines=10000,
+                                      forget_history_messages=None, panel_lines=None):
+    """
+    Insert all queued messages at once and keep at most max_lines lines in the panel.
+
+    While the panel is scrolled up, oldest lines are deleted only above the viewed ones
+    and a page of history over them, so they don't disappear under the reader of
+    history. Viewed lines are deleted too when the panel is twice over max_lines.
+    Deleted lines are forgotten by panel_lines and by forget_history_messages
+    """
+    if panel_lines is None:
+        panel_lines = PanelLines(messages_queue)
+    keep_above = max_lines // 10
     while True:
-        msg = await messages_queue.get()
+        messages = [await messages_queue.get()]
+        while not messages_queue.empty():
+            messages.append(messages_queue.get_nowait())
+        panel_lines.add_received(len(messages))
+
+        is_scrolled_to_end = panel.yview()[1] == 1
+        evicted_count = 0
+        if is_scrolled_to_end and len(messages) > max_lines:
+            # the rest of batch replaces the whole panel, so lines above it go too
+            evicted_count = len(messages) - max_lines
+            messages = messages[evicted_count:]
 
         panel['state'] = 'normal'
         if panel.index('end-1c') != '1.0':
             panel.insert('end', '\n')
-        panel.insert('end', msg)
-        # TODO сделать промотку умной, чтобы не мешала просматривать историю сообщений
-        # ScrolledText.frame
-        # ScrolledText.vbar
-        panel.yview(tk.END)
+        panel.insert('end', '\n'.join(map(str, messages)))
+
+        lines_count = int(panel.index('end-1c').split('.')[0])
+        deleted_count = lines_count - max_lines
+        if deleted_count > 0 and not is_scrolled_to_end:
+            top_line = int(panel.index('@0,0').split('.')[0])
+            deleted_count = max(min(deleted_count, top_line - 1 - keep_above),
+                                lines_count - 2 * max_lines)
+        if deleted_count > 0:
+            panel.delete('1.0', f'{deleted_count + 1}.0')
+            evicted_count += deleted_count
+
+        if is_scrolled_to_end:
+            panel.yview(tk.END)
+        elif deleted_count > 0:
+            # keep in view the line which was on the top before deleting
+            panel.yview(f'{max(top_line - deleted_count, 1)}.0')
+        panel['state'] = 'disabled'
+        # update_tk polls rarely while window is idle, so panel is redrawn right away
+        panel.update_idletasks()
+
+        if not evicted_count:
+            continue
+        # panel lines are counted in order of evicting, pre-trimmed messages are
+        # below all lines which were in the panel
+        history_count, saved_count = panel_lines.evict(evicted_count)
+        if forget_history_messages is not None:
+            forget_history_messages(history_count, saved_count)
+
+
+def bind_history_loading(panel, load_older_messages, panel_lines, retry_interval=200):
+    """
+    Prepend older messages into the panel when it is scrolled to the top.
+
+    Return function which loads the next older page and returns count of its messages.
+    If messages before the oldest shown one aren't saved yet, loading is repeated
+    after retry_interval milliseconds
+    """
+    loading_scheduled = False
+
+    def load_older():
+        nonlocal loading_scheduled
+        loading_scheduled = False
+
+        messages = load_older_messages()
+        if messages is None:
+            loading_scheduled = True
+            panel.after(retry_interval, load_older)
+            return 0
+        if not messages:
+            return 0
+
+        is_empty = panel.index('end-1c') == '1.0'
+        panel['state'] = 'normal'
+        panel.insert('1.0', '\n'.join(messages) + ('' if is_empty else '\n'))
         panel['state'] = 'disabled'
+        panel_lines.history_count += len(messages)
+        # keep in view the line which was on the top before loading
+        panel.yview(f'{len(messages) + 1}.0')
+        return len(messages)
+
+    def on_scroll(first, last):
+        nonlocal loading_scheduled
+        panel.vbar.set(first, last)
+        is_empty = panel.index('end-1c') == '1.0'
+        if float(first) == 0 and not is_empty and not loading_scheduled:
+            loading_scheduled = True
+            panel.after_idle(load_older)
+
+    panel['yscrollcommand'] = on_scroll
+    return load_older
+
+
+def create_search_panel(root_frame, panel, search_messages, get_history_start_id,
+                        panel_lines, load_older=None, max_pages=20):
+    """
+    Search box over history, choosing a result scrolls the panel to its message.
+
+    Line of result is found by its id in history, messages of this run are numbered
+    from get_history_start_id. If message is older than loaded lines, up to max_pages
+    of history are loaded to find it
+    """
+    search_frame = tk.Frame(root_frame)
+    search_frame.pack(side="top", fill=tk.X, before=panel.frame)
+
+    search_field = tk.Entry(search_frame)
+    search_field.pack(side="left", fill=tk.X, expand=True)
+
+    search_button = tk.Button(search_frame)
+    search_button["text"] = "Найти"
+    search_button.pack(side="left")
+
+    results_list = tk.Listbox(root_frame, height=8)
+    panel.tag_configure('found', background='yellow')
+    results = []
+
+    def search(event=None):
+        nonlocal results
+        query = search_field.get().strip()
+        results = search_messages(query) if query else []
+        results_list.delete(0, tk.END)
+        if not results:
+            results_list.pack_forget()
+            return
+        results_list.insert(tk.END, *(str(result) for result in results))
+        results_list.see(tk.END)
+        results_list.pack(side="top", fill=tk.X, after=search_frame)
+
+    def jump(event=None):
+        selection = results_list.curselection()
+        if not selection:
+            return
+        # the same text can be in many lines, so line is found by id, not by text
+        number = results[selection[0]].id - get_history_start_id()
+
+        line = panel_lines.find_line(number)
+        loaded_pages = 0
+        # only history lines can be loaded, received message is shown or dropped
+        while (not line and number <= panel_lines.history_end_number
+               and load_older is not None and loaded_pages < max_pages):
+            if not load_older():
+                break
+            loaded_pages += 1
+            line = panel_lines.find_line(number)
+        if not line:
+            panel.bell()
+            return
+
+        index = f'{line}.0'
+        panel.tag_remove('found', '1.0', 'end')
+        panel.tag_add('found', index, f'{index} lineend')
+        panel.see(index)
+
+    search_field.bind("<Return>", search)
+    search_button["command"] = search
+    results_list.bind("<Double-Button-1>", jump)
+    results_list.bind("<Return>", jump)
 
 
 async def update_status_panel(status_labels, status_updates_queue):
@@ -79,9 +297,19 @@ async def update_status_panel(status_labels, status_updates_queue):
         if isinstance(msg, SendingConnectionStateChanged):
             write_label['text'] = f'Отправка: {msg}'
 
+        if isinstance(msg, ReconnectScheduled):
+            reason = 'сервер недоступен, ' if msg.is_circuit_open else ''
+            text = f'{reason}переподключение через {msg.delay:.0f} с'
+            if msg.state_type is ReadConnectionStateChanged:
+                read_label['text'] = f'Чтение: {text}'
+            else:
+                write_label['text'] = f'Отправка: {text}'
+
         if isinstance(msg, NicknameReceived):
             nickname_label['text'] = f'Имя пользователя: {msg.nickname}'
 
+        nickname_label.update_idletasks()
+
 
 def create_status_panel(root_frame):
     status_frame = tk.Frame(root_frame)
@@ -102,7 +330,9 @@ def create_status_panel(root_frame):
     return (nickname_label, status_read_label, status_write_label)
 
 
-async def draw(messages_queue, sending_queue, status_updates_queue):
+async def draw(messages_queue, sending_queue, status_updates_queue,
+               load_older_messages=None, forget_history_messages=None,
+               search_messages=None, get_history_start_id=None):
     root = tk.Tk()
 
     root.title('Чат Майнкрафтера')
@@ -127,8 +357,20 @@ async def draw(messages_queue, sending_queue, status_updates_queue):
 
     conversation_panel = ScrolledText(root_frame, wrap='none')
     conversation_panel.pack(side="top", fill="both", expand=True)
+    panel_lines = PanelLines(messages_queue)
+    load_older = None
+    if load_older_messages is not None:
+        load_older = bind_history_loading(conversation_panel, load_older_messages,
+                                          panel_lines)
+        # the last page of history is the first older page
+        load_older()
+        conversation_panel.yview(tk.END)
+    if search_messages is not None:
+        create_search_panel(root_frame, conversation_panel, search_messages,
+                            get_history_start_id, panel_lines, load_older)
 
     async with create_task_group() as tg:
         tg.start_soon(update_tk, root_frame)
-        tg.start_soon(update_conversation_history, conversation_panel, messages_queue)
+        tg.start_soon(update_conversation_history, conversation_panel, messages_queue,
+                      10000, forget_history_messages, panel_lines)
         tg.start_soon(update_status_panel, status_labels, status_updates_queue)
@@ -0,0 +1,249 @@
+import asyncio
+import bisect
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+import anyio
+
+logger = logging.getLogger(__name__)
+
+# seconds, from fast disk flush to slow handshake
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    """Monotonic value, with func the value is read from it on export"""
+
+    kind = 'counter'
+    __slots__ = ('value', 'func')
+
+    def __init__(self, func: Optional[Callable[[], float]] = None):
+        self.value = 0
+        self.func = func
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def get(self) -> Optional[float]:
+        return self.func() if self.func is not None else self.value
+
+
+class Gauge(Counter):
+    """Value which goes up and down, with func the value is read from it on export"""
+
+    kind = 'gauge'
+    __slots__ = ()
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+
+class Histogram:
+    """Count of observed values by buckets, their sum and count"""
+
+    kind = 'histogram'
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # the last count is for values above all buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get(self) -> dict[str, Union[float, dict[str, int]]]:
+        cumulative_counts = {}
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            cumulative_counts[format_number(bound)] = total
+        return {'buckets': cumulative_counts, 'sum': self.sum, 'count': self.count}
+
+
+class NullMetric:
+    """Metric of disabled registry, every call does nothing"""
+
+    __slots__ = ()
+
+    def inc(self, amount: float = 1) -> None:
+        pass
+
+    def dec(self, amount: float = 1) -> None:
+        pass
+
+    def set(self, value: float) -> None:
+        pass
+
+    def observe(self, value: float) -> None:
+        pass
+
+
+NULL_METRIC = NullMetric()
+
+Metric = Union[Counter, Gauge, Histogram, NullMetric]
+
+
+class MetricsRegistry:
+    """
+    Named metrics with labels.
+
+    While registry is disabled, it returns NULL_METRIC, so instrumented code costs
+    one empty method call. Enable registry before creation of instrumented objects
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        # name -> (kind, help, {labels: metric})
+        self._metrics = {}
+
+    def counter(self, name: str, help_text: str,
+                func: Optional[Callable[[], float]] = None, **labels: str) -> Metric:
+        return self._get(Counter, name, help_text, labels, func)
+
+    def gauge(self, name: str, help_text: str, func: Optional[Callable[[], float]] = None,
+              **labels: str) -> Metric:
+        return self._get(Gauge, name, help_text, labels, func)
+
+    def histogram(self, name: str, help_text: str,
+                  buckets: tuple[float, ...] = DEFAULT_BUCKETS, **labels: str) -> Metric:
+        return self._get(Histogram, name, help_text, labels, buckets)
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for name, (kind, help_text, metrics) in sorted(self._metrics.items()):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, metric in metrics.items():
+                value = metric.get()
+                if value is None:
+                    continue
+                if kind != 'histogram':
+                    lines.append(f'{name}{format_labels(labels)} {format_number(value)}')
+                    continue
+                for bound, count in value['buckets'].items():
+                    bucket_labels = labels + (('le', bound),)
+                    lines.append(f'{name}_bucket{format_labels(bucket_labels)} {count}')
+                lines.append(
+                    f'{name}_sum{format_labels(labels)} {format_number(value["sum"])}')
+                lines.append(f'{name}_count{format_labels(labels)} {value["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self) -> dict[str, list[dict]]:
+        return {
+            name: [{'labels': dict(labels), 'value': metric.get()}
+                   for labels, metric in metrics.items()]
+            for name, (_, _, metrics) in sorted(self._metrics.items())
+        }
+
+    def _get(self, metric_type: type, name: str, help_text: str, labels: dict[str, str],
+             argument) -> Metric:
+        if not self.enabled:
+            return NULL_METRIC
+
+        _, _, metrics = self._metrics.setdefault(name, (metric_type.kind, help_text, {}))
+        key = tuple(sorted((label, str(value)) for label, value in labels.items()))
+        metric = metrics.get(key)
+        if metric is None:
+            metric = metric_type(argument) if argument is not None else metric_type()
+            metrics[key] = metric
+        return metric
+
+
+registry = MetricsRegistry()
+
+
+def enable() -> None:
+    registry.enabled = True
+
+
+def counter(name: str, help_text: str, func: Optional[Callable[[], float]] = None,
+            **labels: str) -> Metric:
+    return registry.counter(name, help_text, func, **labels)
+
+
+def gauge(name: str, help_text: str, func: Optional[Callable[[], float]] = None,
+          **labels: str) -> Metric:
+    return registry.gauge(name, help_text, func, **labels)
+
+
+def histogram(name: str, help_text: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+              **labels: str) -> Metric:
+    return registry.histogram(name, help_text, buckets, **labels)
+
+
+def format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"') for _, value in labels)
+    pairs = (f'{label}="{value}"' for (label, _), value in zip(labels, escaped))
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+async def handle_scrape(reader: asyncio.StreamReader,
+                        writer: asyncio.StreamWriter) -> None:
+    """Answer any HTTP request by metrics in Prometheus text format"""
+    try:
+        while (await reader.readline()).strip():
+            pass
+        body = registry.render_prometheus().encode()
+        writer.write(b'HTTP/1.0 200 OK\r\n'
+                     b'Content-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: %d\r\n\r\n' % len(body) + body)
+        await writer.drain()
+    except ConnectionError:
+        logger.debug('metrics scraper is disconnected')
+    finally:
+        writer.close()
+
+
+async def serve_prometheus(port: int, host: str = '127.0.0.1') -> None:
+    server = await asyncio.start_server(handle_scrape, host, port)
+    logger.info('metrics on http://%s:%s/metrics', host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def dump_json(path: Path) -> None:
+    """Replace file with current metrics, so reader never sees half written file"""
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w', encoding='UTF8') as f:
+        json.dump(registry.to_dict(), f, indent=1)
+    os.replace(tmp_path, path)
+
+
+async def dump_json_periodically(path: Path, interval: float) -> None:
+    try:
+        while True:
+            await anyio.sleep(interval)
+            dump_json(path)
+    finally:
+        # the last values are dumped on shutdown too
+        dump_json(path)
+
+
+async def export(port: Optional[int] = None, path: Optional[Path] = None,
+                 interval: float = 10.0) -> None:
+    """Run configured exporters until cancellation"""
+    async with anyio.create_task_group() as tg:
+        if port is not None:
+            tg.start_soon(serve_prometheus, port)
+        if path is not None:
+            tg.start_soon(dump_json_periodically, path, interval)
@@ -0,0 +1,189 @@
+import asyncio
+from collections import deque
+from enum import Enum, IntEnum
+import time
+from typing import Any, Callable, Hashable, Optional
+
+import metrics
+
+
+class OverflowPolicy(Enum):
+    # put waits for free place, put_nowait raises QueueFull
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop-oldest'
+    # queued item with the same key is replaced, without such item the oldest is dropped
+    COALESCE = 'coalesce'
+
+
+class BoundedQueue(asyncio.Queue):
+    """
+    Queue with explicit behavior on overflow.
+
+    Counts dropped and coalesced items and keeps the max size which queue has reached
+    """
+
+    def __init__(self, maxsize: int, overflow: OverflowPolicy = OverflowPolicy.BLOCK,
+                 coalesce_key: Optional[Callable[[Any], Hashable]] = None):
+        if overflow is OverflowPolicy.COALESCE and coalesce_key is None:
+            raise ValueError('coalesce_key is required for coalesce policy')
+
+        super().__init__(maxsize)
+        self.overflow = overflow
+        self.coalesce_key = coalesce_key
+
+        self.dropped_count = 0
+        self.coalesced_count = 0
+        self.high_water_mark = 0
+
+    async def put(self, item: Any) -> None:
+        if self.overflow is OverflowPolicy.BLOCK:
+            await super().put(item)
+        else:
+            self.put_nowait(item)
+
+    def put_nowait(self, item: Any) -> None:
+        if self.overflow is OverflowPolicy.COALESCE and self._replace(item):
+            self.coalesced_count += 1
+            return
+
+        if self.full() and self.overflow is not OverflowPolicy.BLOCK:
+            self._queue.popleft()
+            self.task_done()
+            self.dropped_count += 1
+
+        super().put_nowait(item)
+        self.high_water_mark = max(self.high_water_mark, self.qsize())
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'size': self.qsize(),
+            'high_water_mark': self.high_water_mark,
+            'dropped': self.dropped_count,
+            'coalesced': self.coalesced_count,
+        }
+
+    def _replace(self, item: Any) -> bool:
+        key = self.coalesce_key(item)
+        for i, queued_item in enumerate(self._queue):
+            if self.coalesce_key(queued_item) == key:
+                self._queue[i] = item
+                return True
+        return False
+
+
+class SendPriority(IntEnum):
+    # lower value is sent first
+    USER = 0
+    SYSTEM = 1
+    KEEPALIVE = 2
+
+
+class TokenBucket:
+    """Limit of rate items per second with bursts up to burst items, 0 rate is no limit"""
+
+    def __init__(self, rate: float = 0, burst: int = 10):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+
+    async def acquire(self) -> None:
+        """Take one token, wait for it if bucket is empty. Bucket has only one consumer"""
+        if not self.rate:
+            return
+
+        self._refill()
+        if self.tokens < 1:
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+            self._refill()
+        self.tokens -= 1
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+
+class SendScheduler:
+    """
+    Queue of messages to send with priority classes and rate limit.
+
+    get returns the oldest item of the most prior class after token of rate limit
+    is taken. Empty item is keepalive, other items are user messages by default.
+    Keepalive is redundant while anything else is queued or sent, because reply on any
+    message proves that connection is alive, so such keepalives are coalesced.
+    Delay between put and get is observed by priority class.
+
+    User and system items are limited by maxsize,
+    put_nowait raises QueueFull like asyncio.Queue
+    """
+
+    def __init__(self, maxsize: int = 1000, rate: float = 0, burst: int = 10):
+        self.maxsize = maxsize
+        self.bucket = TokenBucket(rate, burst)
+        # priority -> (enqueued_at, item) from the oldest to the newest
+        self._queues = {priority: deque() for priority in SendPriority}
+        self._size = 0
+        self._not_empty = asyncio.Event()
+
+        self.coalesced_count = 0
+        self.high_water_mark = 0
+        self._delays = {
+            priority: metrics.histogram('chat_send_queue_delay_seconds',
+                                        'Time of message in sending queue',
+                                        priority=priority.name.lower())
+            for priority in SendPriority
+        }
+
+    def qsize(self) -> int:
+        return self._size
+
+    def empty(self) -> bool:
+        return not self._size
+
+    def full(self) -> bool:
+        return self._size - len(self._queues[SendPriority.KEEPALIVE]) >= self.maxsize
+
+    def put_nowait(self, item: str, priority: Optional[SendPriority] = None) -> None:
+        if priority is None:
+            priority = SendPriority.USER if item else SendPriority.KEEPALIVE
+
+        if priority is SendPriority.KEEPALIVE:
+            if self._size:
+                self.coalesced_count += 1
+                return
+        elif self.full():
+            raise asyncio.QueueFull
+
+        self._queues[priority].append((time.monotonic(), item))
+        self._size += 1
+        self.high_water_mark = max(self.high_water_mark, self._size)
+        self._not_empty.set()
+
+    async def get(self) -> str:
+        while not self._size:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+
+        # the most prior item is chosen after waiting, it can outrun items queued earlier
+        await self.bucket.acquire()
+        for priority, queue in self._queues.items():
+            if queue:
+                enqueued_at, item = queue.popleft()
+                break
+        self._size -= 1
+        self._delays[priority].observe(time.monotonic() - enqueued_at)
+
+        keepalives = self._queues[SendPriority.KEEPALIVE]
+        if priority is not SendPriority.KEEPALIVE and keepalives:
+            self.coalesced_count += len(keepalives)
+            self._size -= len(keepalives)
+            keepalives.clear()
+        return item
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'size': self.qsize(),
+            'high_water_mark': self.high_water_mark,
+            'coalesced': self.coalesced_count,
+        }
@@ -0,0 +1,66 @@
+from enum import Enum
+import random
+import time
+
+
+class CircuitState(Enum):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+
+class ReconnectPolicy:
+    """
+    Delays between reconnections: exponential backoff with full jitter.
+
+    After failure_threshold failures in a row the circuit is open and the next attempt
+    is done only after about open_seconds. That attempt is half open: success closes
+    the circuit, failure opens it again.
+
+    Established connection isn't a success yet, server may drop it right away.
+    Success is recorded by the first message or reply in connection, or when connection
+    was alive for healthy_seconds before its failure
+    """
+
+    def __init__(self, base_delay: float = 1.0, max_delay: float = 30.0,
+                 failure_threshold: int = 8, open_seconds: float = 60.0,
+                 healthy_seconds: float = 10.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.healthy_seconds = healthy_seconds
+
+        self.failures_count = 0
+        self.state = CircuitState.CLOSED
+        self._connected_at = None
+
+    def next_delay(self) -> float:
+        """Register failure and return seconds to wait before the next attempt"""
+        if (self._connected_at is not None
+                and time.monotonic() - self._connected_at >= self.healthy_seconds):
+            # connection was healthy even if nothing was received in it
+            self.record_success()
+        self._connected_at = None
+        self.failures_count += 1
+        if (self.state is CircuitState.HALF_OPEN
+                or self.failures_count >= self.failure_threshold):
+            self.state = CircuitState.OPEN
+            return random.uniform(self.open_seconds / 2, self.open_seconds)
+
+        backoff = self.base_delay * 2 ** (self.failures_count - 1)
+        return random.uniform(0, min(self.max_delay, backoff))
+
+    def attempt(self) -> None:
+        """Call before connection attempt"""
+        if self.state is CircuitState.OPEN:
+            self.state = CircuitState.HALF_OPEN
+
+    def record_connected(self) -> None:
+        """Call when connection is established"""
+        self._connected_at = time.monotonic()
+
+    def record_success(self) -> None:
+        """Call when connection proved to be healthy"""
+        self.failures_count = 0
+        self.state = CircuitState.CLOSED
@@ -1,20 +1,29 @@
 import asyncio
 import argparse
 import json
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
+import sys
+import time
 from tkinter import TclError
 import logging
+from typing import Iterable, Optional
 
-import aiofiles
 import anyio
 
 import registrator_gui as gui
 from context_managers import open_connection
+from credentials import CredentialStore
+from reconnect import ReconnectPolicy
+from tk_display import TkAppClosed
 
 logger = logging.getLogger(__name__)
 
 
+class UnconfirmedRegistrationError(Exception):
+    """Nickname is sent, but reply is lost, so nickname may be registered"""
+
+
 async def write_message(writer: asyncio.StreamWriter, text: str) -> None:
     """Wrapper of stream message sending"""
     text = text.encode()
@@ -23,47 +32,188 @@ async def write_message(writer: asyncio.StreamWriter, text: str) -> None:
     await writer.drain()
 
 
-async def register(host: str, port: int, credential_path: Path, sending_queue: asyncio.Queue,
+async def register_nickname(host: str, port: int, nickname: str,
+                            timeout: Optional[float] = None) -> dict[str, str]:
+    """
+    Register nickname in new connection and return its credentials.
+
+    Connection errors and timeout after nickname is sent are raised
+    as UnconfirmedRegistrationError, such registration must not be repeated
+    """
+    nickname_sent = False
+    credentials_msg = b''
+    try:
+        with anyio.fail_after(timeout):
+            async with open_connection(host, port) as (reader, writer):
+                greeting_msg = await reader.readline()
+                logger.debug(f'RECEIVE: {greeting_msg.decode().strip()}')
+
+                # send null for registration
+                await write_message(writer, '\n')
+
+                instruction_msg = await reader.readline()
+                logger.debug(f'RECEIVE: {instruction_msg.decode().strip()}')
+                if not greeting_msg or not instruction_msg:
+                    raise ConnectionError('connection is closed before registration')
+
+                nickname_sent = True
+                await write_message(writer, f'{nickname}\n')
+
+                credentials_msg = await reader.readline()
+                logger.debug(f'RECEIVE: {credentials_msg.decode().strip()}')
+    except (OSError, TimeoutError) as e:
+        # error on closing after reply doesn't matter
+        if nickname_sent and not credentials_msg:
+            raise UnconfirmedRegistrationError(
+                f'{nickname} is sent, but reply is lost') from e
+        if not nickname_sent:
+            raise
+
+    if not credentials_msg:
+        raise UnconfirmedRegistrationError(
+            f'{nickname} is sent, but connection is closed before reply')
+    credentials = json.loads(credentials_msg.decode().strip())
+    if not credentials:
+        raise ValueError(f'{nickname} is not registered')
+    return credentials
+
+
+async def register(host: str, port: int, credential_store: CredentialStore,
+                   sending_queue: asyncio.Queue,
                    creds_updates_queue: asyncio.Queue) -> None:
     """Register in chat coroutine. While true loop because interface supports many registrations"""
     while True:
+        username = await sending_queue.get()
+
         logger.info('registration...')
-        async with open_connection(host, port) as (reader, writer):
-            greeting_msg = await reader.readline()
-            logger.debug(f'RECEIVE: {greeting_msg.decode().strip()}')
+        credentials = await register_nickname(host, port, username)
 
-            # send null for registration
-            await write_message(writer, '\n')
+        creds_updates_queue.put_nowait(
+            gui.Credentials(nickname=credentials['nickname'], token=credentials['account_hash']))
 
-            instruction_msg = await reader.readline()
-            logger.debug(f'RECEIVE: {instruction_msg.decode().strip()}')
+        credential_store.add(credentials)
 
-            username = await sending_queue.get()
+        logger.info('success registration')
 
-            await write_message(writer, f'{username}\n')
 
-            credentials_msg = await reader.readline()
-            logger.debug(f'RECEIVE: {credentials_msg.decode().strip()}')
+@dataclass
+class RegistrationStats:
+    registered_count: int = 0
+    failed_count: int = 0
+    retries_count: int = 0
+    elapsed: float = 0.0
+    failed_nicknames: list[str] = field(default_factory=list)
+    # failed after nickname is sent, they may be registered without saved credentials
+    unconfirmed_nicknames: list[str] = field(default_factory=list)
 
-        credentials = json.loads(credentials_msg.decode().strip())
+    @property
+    def rate(self) -> float:
+        return self.registered_count / self.elapsed if self.elapsed else 0.0
 
-        creds_updates_queue.put_nowait(
-            gui.Credentials(nickname=credentials['nickname'], token=credentials['account_hash']))
+    def __str__(self):
+        return (f'{self.registered_count} registered, {self.failed_count} failed, '
+                f'{self.retries_count} retries in {self.elapsed:.1f}s, '
+                f'{self.rate:.0f} registrations/sec')
 
-        async with aiofiles.open(credential_path, 'a', encoding='UTF8') as f:
-            await f.write(json.dumps(credentials) + '\n')
 
-        logger.info('success registration')
+async def register_bulk(host: str, port: int, nicknames: Iterable[str],
+                        credential_store: CredentialStore, *, concurrency: int = 10,
+                        retries: int = 3, timeout: float = 10.0, flush_size: int = 100,
+                        flush_interval: float = 1.0) -> RegistrationStats:
+    """
+    Register nicknames by concurrency parallel connections.
+
+    Registration which fails before nickname is sent is retried up to retries times
+    with growing delay. After nickname is sent it is never retried, because chat may
+    have registered it already, so retry would create one more account.
+    Credentials are appended to store by batches of flush_size or every flush_interval
+    seconds, so after crash only the last batch has to be registered again
+    """
+    stats = RegistrationStats()
+    pending_nicknames = iter(nicknames)
+    credentials_batch = []
+
+    def flush() -> None:
+        nonlocal credentials_batch
+        credential_store.add_many(credentials_batch)
+        credentials_batch = []
+
+    async def register_with_retries(nickname: str) -> Optional[dict[str, str]]:
+        retry_policy = ReconnectPolicy(base_delay=0.5, max_delay=5.0)
+        for attempt in range(retries + 1):
+            try:
+                return await register_nickname(host, port, nickname, timeout)
+            except UnconfirmedRegistrationError as e:
+                logger.warning('%s registration is unconfirmed: %r', nickname, e)
+                stats.unconfirmed_nicknames.append(nickname)
+                return None
+            except ValueError as e:
+                # chat replied, so the same nickname would be refused again
+                logger.warning('%s registration failed: %r', nickname, e)
+                return None
+            except (OSError, TimeoutError) as e:
+                logger.warning('%s registration failed: %r', nickname, e)
+                if attempt == retries:
+                    return None
+                stats.retries_count += 1
+                await anyio.sleep(retry_policy.next_delay())
+
+    async def run_worker() -> None:
+        # all workers share one iterator, so nicknames are read lazily
+        for nickname in pending_nicknames:
+            credentials = await register_with_retries(nickname)
+            if credentials is None:
+                stats.failed_count += 1
+                stats.failed_nicknames.append(nickname)
+                continue
+            stats.registered_count += 1
+            credentials_batch.append(credentials)
+            if len(credentials_batch) >= flush_size:
+                flush()
+
+    async def flush_periodically() -> None:
+        while True:
+            await anyio.sleep(flush_interval)
+            flush()
+
+    started_at = time.perf_counter()
+    try:
+        async with anyio.create_task_group() as tg:
+            tg.start_soon(flush_periodically)
+            async with anyio.create_task_group() as workers_tg:
+                for _ in range(concurrency):
+                    workers_tg.start_soon(run_worker)
+            tg.cancel_scope.cancel()
+    finally:
+        flush()
+        stats.elapsed = time.perf_counter() - started_at
+    return stats
+
+
+def read_nicknames(nicknames_path: Path) -> Iterable[str]:
+    """Nicknames from file or stdin if path is -, one per line"""
+    if str(nicknames_path) == '-':
+        lines = sys.stdin
+    else:
+        lines = open(nicknames_path, encoding='UTF8')
+    with lines:
+        for line in lines:
+            nickname = line.strip()
+            if nickname:
+                yield nickname
 
 
 @dataclass
 class Options:
-    listen_host: str
-    listen_port: int
+    listen_host: Optional[str]
+    listen_port: Optional[int]
     history_path: Path
     write_host: str
     write_port: int
     credential_path: Path
+    nicknames_path: Optional[Path] = None
+    concurrency: int = 10
+    retries: int = 3
     token: str = ''
 
 
@@ -75,29 +225,60 @@ async def main():
         description='UI for registration users in chat with possibility going to chat',
     )
 
-    parser.add_argument('-lh', '--listen_host', type=str, required=True, help='host of chat to listen')
-    parser.add_argument('-lp', '--listen_port', type=int, required=True, help='port of chat to listen')
+    parser.add_argument('-lh', '--listen_host', type=str, default=None,
+                        help='host of chat to listen')
+    parser.add_argument('-lp', '--listen_port', type=int, default=None,
+                        help='port of chat to listen')
     parser.add_argument('-hp', '--history_path',
                         type=Path, default='chat_history.txt', help='path to file with messages')
     parser.add_argument('-wh', '--write_host', type=str, required=True, help='host of chat to write')
     parser.add_argument('-wp', '--write_port', type=int, required=True, help='port of chat to write')
     parser.add_argument('-cp', '--credential_path',
                         type=Path, default='creds.jsonstream', help='path to file with credentials')
+    parser.add_argument('-np', '--nicknames_path', type=Path, default=None,
+                        help='register nicknames from file '
+                             '(one per line, - is stdin) without UI')
+    parser.add_argument('-c', '--concurrency', type=int, default=10,
+                        help='count of parallel registrations without UI')
+    parser.add_argument('-r', '--retries', type=int, default=3,
+                        help='count of retries of registration which failed '
+                             'before nickname is sent, without UI')
 
     args = parser.parse_args()
+    if args.nicknames_path is None and (args.listen_host is None
+                                        or args.listen_port is None):
+        parser.error('listen host and port are required for UI')
 
     options = Options(**args.__dict__)
 
+    if options.nicknames_path is not None:
+        # only failures are logged, lines of every registration would slow it down
+        logging.disable(logging.INFO)
+        with CredentialStore(options.credential_path) as credential_store:
+            stats = await register_bulk(
+                options.write_host, options.write_port,
+                read_nicknames(options.nicknames_path), credential_store,
+                concurrency=options.concurrency, retries=options.retries)
+        print(stats)
+        unconfirmed_nicknames = set(stats.unconfirmed_nicknames)
+        for nickname in stats.failed_nicknames:
+            if nickname in unconfirmed_nicknames:
+                print(f'unconfirmed: {nickname}', file=sys.stderr)
+            else:
+                print(f'failed: {nickname}', file=sys.stderr)
+        return
+
     sending_queue = asyncio.Queue()
     creds_updates_queue = asyncio.Queue()
-    async with anyio.create_task_group() as tg:
-        tg.start_soon(gui.draw, sending_queue, creds_updates_queue, options)
-        tg.start_soon(register, options.write_host, options.write_port, options.credential_path,
-                      sending_queue, creds_updates_queue)
+    with CredentialStore(options.credential_path) as credential_store:
+        async with anyio.create_task_group() as tg:
+            tg.start_soon(gui.draw, sending_queue, creds_updates_queue, options)
+            tg.start_soon(register, options.write_host, options.write_port,
+                          credential_store, sending_queue, creds_updates_queue)
 
 
 if __name__ == '__main__':
     try:
         anyio.run(main)
-    except (KeyboardInterrupt, gui.TkAppClosed, TclError):
+    except (KeyboardInterrupt, TkAppClosed, TclError):
         pass
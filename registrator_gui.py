@@ -1,4 +1,3 @@
-import asyncio
 import tkinter as tk
 from dataclasses import dataclass
 import subprocess
@@ -7,9 +6,7 @@ from tkinter import messagebox
 
 from anyio import create_task_group
 
-
-class TkAppClosed(Exception):
-    pass
+from tk_display import update_tk
 
 
 @dataclass
@@ -18,16 +15,6 @@ class Credentials:
     token: str
 
 
-async def update_tk(root_frame, interval=1 / 120):
-    while True:
-        try:
-            root_frame.update()
-        except tk.TclError:
-            # if application has been destroyed/closed
-            raise TkAppClosed()
-        await asyncio.sleep(interval)
-
-
 def process_new_message(input_field, sending_queue):
     text = input_field.get()
     sending_queue.put_nowait(text)
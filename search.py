@@ -0,0 +1,357 @@
+import argparse
+from dataclasses import dataclass
+import datetime
+import logging
+from pathlib import Path
+import sqlite3
+import sys
+import time
+from typing import Optional
+
+import anyio
+
+from history import HistoryArchive, MappedHistoryReader, TimestampFormatter
+
+logger = logging.getLogger(__name__)
+
+TIMESTAMP_FORMAT = TimestampFormatter().fmt
+# trigram index can't find shorter strings, they are found by scan of messages
+MIN_INDEXED_SIZE = 3
+
+
+@dataclass
+class SearchResult:
+    id: int
+    time: Optional[datetime.datetime]
+    author: Optional[str]
+    message: str
+
+    def __str__(self):
+        if self.time is None:
+            return self.message
+        return f'[{self.time.strftime(TIMESTAMP_FORMAT)}] {self.message}'
+
+
+class SearchIndex:
+    """
+    Full-text index over history file and its rotated segments in sqlite FTS5.
+
+    Index is incremental: like reader of credentials it remembers how many bytes of
+    history are indexed and reads only appended lines. Messages are indexed by trigrams,
+    so any substring of 3 and more characters is found without scan of history.
+
+    update does blocking file and sqlite work, run calls it in a thread, so indexing
+    doesn't block event loop. Searches use their own connection and are not blocked
+    by indexing.
+    """
+
+    def __init__(self, history_path: Path, index_path: Optional[Path] = None):
+        self.history_path = history_path
+        self.index_path = index_path or history_path.with_name(
+            history_path.name + '.index.sqlite')
+        self.archive = HistoryArchive(history_path)
+
+        # connection for indexing is used by one thread at a time
+        self._db = sqlite3.connect(self.index_path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS messages '
+                '(id INTEGER PRIMARY KEY, time INTEGER, author TEXT, '
+                'message TEXT NOT NULL)')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS messages_time ON messages (time)')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS messages_author ON messages (author)')
+            self._db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 "
+                "(message, content='messages', content_rowid='id', tokenize='trigram')")
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS meta '
+                '(segments INTEGER NOT NULL, offset INTEGER NOT NULL, '
+                'first_id INTEGER NOT NULL)')
+            row = self._db.execute(
+                'SELECT segments, offset, first_id FROM meta').fetchone()
+            if row is None:
+                self._db.execute(
+                    'INSERT INTO meta (segments, offset, first_id) VALUES (0, 0, 1)')
+                row = (0, 0, 1)
+        # count of completely indexed segments, indexed bytes of the next source
+        # and id of its first message
+        self._segments_count, self._offset, self._first_id = row
+        self._segment_data = None
+
+        self._search_db = sqlite3.connect(self.index_path, check_same_thread=False)
+        self.timestamps = TimestampFormatter()
+
+    def update(self, max_size: int = 1024 * 1024) -> int:
+        """Index up to max_size bytes of new history, return count of new messages"""
+        segments = self.archive.segments()
+        if self._segments_count < len(segments):
+            # the oldest not indexed segment, history file can be rotated during indexing
+            if self._segment_data is None:
+                self._segment_data = self.archive.read_segment(
+                    segments[self._segments_count])
+            data = self._segment_data[self._offset:self._offset + max_size]
+            is_last_data = self._offset + len(data) >= len(self._segment_data)
+        else:
+            data = self._read_history_file(max_size)
+            if data is None or self.archive.segments() != segments:
+                # history file is rotated right now
+                return 0
+            is_last_data = False
+
+        # last line can be written right now, it will be indexed on next update
+        complete_size = len(data) if is_last_data else data.rfind(b'\n') + 1
+        rows = [self._parse(line)
+                for line in data[:complete_size].splitlines() if line.strip()]
+
+        offset = self._offset + complete_size
+        segments_count = self._segments_count
+        first_id = self._first_id
+        if is_last_data:
+            segments_count += 1
+            offset = 0
+            self._segment_data = None
+
+        with self._db:
+            last_id = self._db.execute(
+                'SELECT coalesce(max(id), 0) FROM messages').fetchone()[0]
+            self._db.executemany(
+                'INSERT INTO messages (time, author, message) VALUES (?, ?, ?)', rows)
+            # one statement for the whole batch is several times faster than row trigger
+            self._db.execute(
+                'INSERT INTO messages_fts (rowid, message) '
+                'SELECT id, message FROM messages WHERE id > ?', (last_id,))
+            if is_last_data:
+                first_id = last_id + len(rows) + 1
+            self._db.execute('UPDATE meta SET segments = ?, offset = ?, first_id = ?',
+                             (segments_count, offset, first_id))
+        self._segments_count = segments_count
+        self._offset = offset
+        self._first_id = first_id
+        return len(rows) or int(is_last_data)
+
+    async def run(self, interval: float = 1.0) -> None:
+        """Keep index up to date with history"""
+        while True:
+            if not await anyio.to_thread.run_sync(self.update):
+                await anyio.sleep(interval)
+
+    def search(self, query: str = '', *, tokens: bool = False,
+               author: Optional[str] = None, since: Optional[datetime.datetime] = None,
+               until: Optional[datetime.datetime] = None,
+               limit: int = 100) -> list[SearchResult]:
+        """
+        Return up to limit the newest messages which match all filters, oldest first.
+
+        Query is a substring of message, with tokens every word of query is looked up
+        separately in any order. Search is case insensitive
+        """
+        terms = query.split() if tokens else [query.strip()]
+        terms = [term for term in terms if term]
+        fts_terms = [term for term in terms if len(term) >= MIN_INDEXED_SIZE]
+
+        conditions = []
+        params = []
+        if fts_terms:
+            conditions.append('messages_fts MATCH ?')
+            params.append(' AND '.join(
+                '"{}"'.format(term.replace('"', '""')) for term in fts_terms))
+        for term in terms:
+            if len(term) < MIN_INDEXED_SIZE:
+                conditions.append("m.message LIKE ? ESCAPE '\\'")
+                escaped = (term.replace('\\', '\\\\')
+                           .replace('%', '\\%').replace('_', '\\_'))
+                params.append(f'%{escaped}%')
+        if author is not None:
+            conditions.append('m.author = ?')
+            params.append(author)
+        if since is not None:
+            conditions.append('m.time >= ?')
+            params.append(int(since.timestamp()))
+        if until is not None:
+            conditions.append('m.time <= ?')
+            params.append(int(until.timestamp()))
+
+        # history is appended in time order, so time range is also a range of ids,
+        # index scans only it instead of all newer messages
+        id_column = 'messages_fts.rowid' if fts_terms else 'm.id'
+        if since is not None or until is not None:
+            first_id, last_id = self._get_ids_range(since, until)
+            conditions.append(f'{id_column} BETWEEN ? AND ?')
+            params += [first_id, last_id]
+
+        if fts_terms:
+            sql = ('SELECT m.id, m.time, m.author, m.message FROM messages_fts '
+                   'JOIN messages AS m ON m.id = messages_fts.rowid')
+        else:
+            sql = 'SELECT m.id, m.time, m.author, m.message FROM messages AS m'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        # order by rowid of index lets FTS5 stop after limit matches
+        sql += f' ORDER BY {id_column} DESC LIMIT ?'
+        params.append(limit)
+
+        rows = self._search_db.execute(sql, params).fetchall()
+        return [
+            SearchResult(
+                id=id_,
+                time=(datetime.datetime.fromtimestamp(timestamp)
+                      if timestamp is not None else None),
+                author=author,
+                message=message,
+            )
+            for id_, timestamp, author, message in reversed(rows)
+        ]
+
+    def close(self) -> None:
+        self._db.close()
+        self._search_db.close()
+
+    def _get_ids_range(self, since: Optional[datetime.datetime],
+                       until: Optional[datetime.datetime]) -> tuple[int, int]:
+        first_id, last_id = 0, sys.maxsize
+        if since is not None:
+            row = self._search_db.execute(
+                'SELECT id FROM messages WHERE time >= ? ORDER BY time LIMIT 1',
+                (int(since.timestamp()),)).fetchone()
+            first_id = row[0] if row is not None else sys.maxsize
+        if until is not None:
+            row = self._search_db.execute(
+                'SELECT id FROM messages WHERE time <= ? ORDER BY time DESC LIMIT 1',
+                (int(until.timestamp()),)).fetchone()
+            last_id = row[0] if row is not None else 0
+        return first_id, last_id
+
+    def _read_history_file(self, max_size: int) -> Optional[bytes]:
+        try:
+            with open(self.history_path, 'rb') as f:
+                size = f.seek(0, 2)
+                if size < self._offset:
+                    logger.warning(
+                        f'{self.history_path} is truncated, index it from the start')
+                    self._reset_history_file()
+                f.seek(self._offset)
+                return f.read(max_size)
+        except FileNotFoundError:
+            return None
+
+    def _reset_history_file(self) -> None:
+        """Forget indexed messages of history file, messages of segments stay"""
+        with self._db:
+            self._db.execute(
+                "INSERT INTO messages_fts (messages_fts, rowid, message) "
+                "SELECT 'delete', id, message FROM messages WHERE id >= ?",
+                (self._first_id,))
+            self._db.execute('DELETE FROM messages WHERE id >= ?', (self._first_id,))
+            self._db.execute('UPDATE meta SET offset = 0')
+        self._offset = 0
+
+    def _parse(self, line: bytes) -> tuple[Optional[int], Optional[str], str]:
+        timestamp, prefix_size = self.timestamps.parse(line)
+        line = line[prefix_size:].decode('UTF8', errors='replace').strip()
+        author, separator, _ = line.partition(': ')
+        return timestamp, author if separator else None, line
+
+
+def read_between(history_path: Path, since: Optional[datetime.datetime],
+                 until: Optional[datetime.datetime]) -> list[str]:
+    """Return history lines of the time range without search index"""
+    timestamps = TimestampFormatter()
+    since_timestamp = since.timestamp() if since is not None else float('-inf')
+    until_timestamp = until.timestamp() if until is not None else float('inf')
+
+    lines = []
+    archive = HistoryArchive(history_path)
+    for segment in archive.segments_between(since or datetime.datetime.min,
+                                            until or datetime.datetime.max):
+        for line in archive.read_segment(segment).splitlines():
+            timestamp, _ = timestamps.parse(line)
+            if timestamp is None or since_timestamp <= timestamp <= until_timestamp:
+                lines.append(line.decode('UTF8', errors='replace'))
+
+    # history file is usually big, so only the lines of the range are read from it
+    reader = MappedHistoryReader(history_path)
+    lines += reader.read_between(since, until)
+    reader.close()
+    return lines
+
+
+@dataclass
+class Options:
+    history_path: Path
+    index_path: Optional[Path]
+    query: str
+    tokens: bool
+    author: Optional[str]
+    since: Optional[datetime.datetime]
+    until: Optional[datetime.datetime]
+    limit: int
+    logging: bool
+
+
+def main(options: Options) -> None:
+    if not options.query and options.author is None and (options.since or options.until):
+        started_at = time.perf_counter()
+        lines = read_between(options.history_path, options.since, options.until)
+        elapsed = time.perf_counter() - started_at
+        for line in lines[-options.limit:]:
+            print(line)
+        print(f'{len(lines)} messages found in {elapsed * 1000:.1f} ms', file=sys.stderr)
+        return
+
+    index = SearchIndex(options.history_path, options.index_path)
+    started_at = time.perf_counter()
+    indexed_count = 0
+    while count := index.update():
+        indexed_count += count
+    if indexed_count:
+        elapsed = time.perf_counter() - started_at
+        print(f'{indexed_count} messages indexed in {elapsed:.1f}s', file=sys.stderr)
+
+    started_at = time.perf_counter()
+    results = index.search(options.query, tokens=options.tokens, author=options.author,
+                           since=options.since, until=options.until, limit=options.limit)
+    elapsed = time.perf_counter() - started_at
+    index.close()
+
+    for result in results:
+        print(result)
+    print(f'{len(results)} messages found in {elapsed * 1000:.1f} ms', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    parser = argparse.ArgumentParser(
+        prog='Chat history search',
+        description='Search messages in chat history, index is updated before search',
+    )
+
+    parser.add_argument('query', nargs='?', default='', help='substring of message')
+    parser.add_argument('-hp', '--history_path', type=Path, required=True,
+                        help='path to file with messages')
+    parser.add_argument('-ip', '--index_path', type=Path, default=None,
+                        help='path to search index, default is next to history file')
+    parser.add_argument('-t', '--tokens', action='store_true', default=False,
+                        help='look up every word of query separately')
+    parser.add_argument('-a', '--author', type=str, default=None,
+                        help='nickname of author')
+    parser.add_argument('-s', '--since', type=datetime.datetime.fromisoformat,
+                        default=None, help='messages since time, e.g. 2023-01-31T12:00')
+    parser.add_argument('-u', '--until', type=datetime.datetime.fromisoformat,
+                        default=None, help='messages until time, e.g. 2023-01-31T12:00')
+    parser.add_argument('-n', '--limit', type=int, default=100,
+                        help='max count of messages')
+    parser.add_argument('-l', '--logging', action='store_true', default=False,
+                        help='is do logging')
+
+    args = parser.parse_args()
+
+    options = Options(**args.__dict__)
+
+    if not options.logging:
+        logging.disable()
+
+    main(options)
@@ -0,0 +1,88 @@
+import asyncio
+import logging
+
+import pytest
+
+import chat_listener
+from fake_server import FakeChat, get_port
+
+HOST = '127.0.0.1'
+
+
+@pytest.fixture(autouse=True)
+def disable_logging():
+    logging.disable()
+    yield
+    logging.disable(logging.NOTSET)
+
+
+def test_broken_channel_does_not_stop_other_channels(tmp_path):
+    lines_count = 100
+
+    async def send_broken_lines(reader, writer):
+        writer.write(b'bot1: \xff\xfe is not utf-8\n')
+        # longer than limit of stream reader
+        writer.write(b'bot1: ' + b'x' * 100_000 + b'\n')
+        await writer.drain()
+        writer.close()
+
+    async def send_lines(reader, writer):
+        for start in range(0, lines_count, 10):
+            writer.write(FakeChat.generate_messages(start, 10))
+            await writer.drain()
+            await asyncio.sleep(0.01)
+        writer.close()
+
+    async def run():
+        broken_server = await asyncio.start_server(send_broken_lines, HOST, 0)
+        server = await asyncio.start_server(send_lines, HOST, 0)
+        broken_path = tmp_path / 'broken.txt'
+        history_path = tmp_path / 'history.txt'
+        options = chat_listener.Options(
+            host=None, port=None, history_path=None, logging=False, reconnect=False,
+            targets=[chat_listener.Channel(HOST, get_port(broken_server), broken_path),
+                     chat_listener.Channel(HOST, get_port(server), history_path)])
+
+        await asyncio.wait_for(chat_listener.echo_chat(options), 10)
+
+        for server in (broken_server, server):
+            server.close()
+        return broken_path.read_text(encoding='UTF8'), history_path.read_text(
+            encoding='UTF8')
+
+    broken_history, history = asyncio.run(run())
+
+    assert broken_history.endswith('bot1: �� is not utf-8\n')
+    assert len(history.splitlines()) == lines_count
+
+
+def test_daemon_mode_writes_the_same_lines_as_line_mode(tmp_path):
+    async def send_lines(reader, writer):
+        writer.write(b'bot1: first \r\n  bot2: second\r\n\r\n')
+        await writer.drain()
+        # the last line is split between chunks and isn't ended by newline
+        writer.write(b'bot1: third\t')
+        await writer.drain()
+        writer.close()
+
+    async def listen(daemon):
+        server = await asyncio.start_server(send_lines, HOST, 0)
+        history_path = tmp_path / f'history_{daemon}.txt'
+        options = chat_listener.Options(
+            host=HOST, port=get_port(server), history_path=history_path, logging=False,
+            reconnect=False, daemon=daemon)
+
+        await asyncio.wait_for(chat_listener.echo_chat(options), 10)
+
+        server.close()
+        # lines without time prefix
+        return [line.split(b'] ', 1)[1]
+                for line in history_path.read_bytes().splitlines()]
+
+    async def run():
+        return await listen(daemon=False), await listen(daemon=True)
+
+    lines, daemon_lines = asyncio.run(run())
+
+    assert lines == [b'bot1: first', b'bot2: second', b'', b'bot1: third']
+    assert daemon_lines == lines
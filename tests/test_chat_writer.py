@@ -0,0 +1,81 @@
+import asyncio
+import io
+import logging
+import sys
+
+import pytest
+
+import chat_writer
+from credentials import CredentialStore
+from fake_server import MESSAGE_SENT, FakeChat, get_port, start_write_server
+
+HOST = '127.0.0.1'
+
+
+@pytest.fixture(autouse=True)
+def disable_logging():
+    logging.disable()
+    yield
+    logging.disable(logging.NOTSET)
+
+
+def make_options(tmp_path, port, token, message='', messages_path=None):
+    return chat_writer.Options(
+        host=HOST, port=port, message=message, messages_path=messages_path,
+        token=token, username='', credential_path=tmp_path / 'creds', logging=False,
+        direct=True)
+
+
+@pytest.mark.parametrize('bulk', [False, True])
+def test_message_with_blank_lines_is_submitted_once(tmp_path, bulk):
+    async def run():
+        chat = FakeChat()
+        server = await start_write_server(HOST, 0, chat)
+        token = chat.register('bot')['account_hash']
+        options = make_options(tmp_path, get_port(server), token, 'first\n\n \nsecond\n')
+        options.bulk = bulk
+
+        await chat_writer.write_chat(options)
+        # the second message would be received right after the first one
+        await asyncio.sleep(0.05)
+
+        assert chat.received_count == 1
+        server.close()
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('is_registered', [False, True])
+def test_the_next_line_after_handshake_is_reply_on_message(tmp_path, is_registered):
+    async def run():
+        chat = FakeChat()
+        server = await start_write_server(HOST, 0, chat)
+        token = chat.register('bot')['account_hash'] if is_registered else ''
+        options = make_options(tmp_path, get_port(server), token)
+        options.username = 'bot'
+
+        with CredentialStore(options.credential_path) as credential_store:
+            reader, writer = await asyncio.open_connection(HOST, get_port(server))
+            await reader.readline()
+            if is_registered:
+                assert await chat_writer.authorize(options, credential_store,
+                                                   reader, writer)
+            else:
+                await chat_writer.register(options, credential_store, reader, writer)
+
+            await chat_writer.submit_message(writer, 'first')
+            assert await reader.readline() == MESSAGE_SENT
+        writer.close()
+        server.close()
+
+    asyncio.run(run())
+
+
+def test_stdin_is_not_closed_after_reading_messages(tmp_path, monkeypatch):
+    stdin = io.StringIO('first\n\nsecond\n')
+    monkeypatch.setattr(sys, 'stdin', stdin)
+
+    messages = list(chat_writer.read_messages(make_options(tmp_path, 0, '')))
+
+    assert messages == ['first', 'second']
+    assert not stdin.closed
@@ -0,0 +1,209 @@
+import asyncio
+import json
+import logging
+import time
+
+import pytest
+
+from authorized_connection import ConnectionPool
+import chat_writer
+from fake_server import FakeChat, get_port, start_write_server
+from reconnect import ReconnectPolicy
+import writer_daemon
+from writer_daemon import WriterDaemon
+
+HOST = '127.0.0.1'
+
+
+@pytest.fixture(autouse=True)
+def disable_logging():
+    logging.disable()
+    yield
+    logging.disable(logging.NOTSET)
+
+
+async def start_chat(nicknames_count: int):
+    chat = FakeChat()
+    server = await start_write_server(HOST, 0, chat)
+    tokens = [chat.register(f'bot{number}')['account_hash']
+              for number in range(nicknames_count)]
+    return chat, server, tokens
+
+
+def test_idle_connection_is_reused():
+    async def run():
+        chat, server, [token] = await start_chat(1)
+        pool = ConnectionPool(max_size=2)
+        async with pool.session(HOST, get_port(server), token) as first:
+            pass
+        async with pool.session(HOST, get_port(server), token) as second:
+            pass
+
+        assert second is first
+        assert chat.connections_count == 1
+        await pool.close()
+        server.close()
+
+    asyncio.run(run())
+
+
+def test_least_recently_used_idle_connection_is_closed_when_pool_is_full():
+    async def run():
+        chat, server, tokens = await start_chat(3)
+        port = get_port(server)
+        pool = ConnectionPool(max_size=2)
+        for token in tokens[:2]:
+            async with pool.session(HOST, port, token):
+                pass
+
+        async with pool.session(HOST, port, tokens[2]):
+            assert pool.size == 2
+            assert pool.idle_count == 1
+
+        # the first connection is closed, so it is opened again
+        async with pool.session(HOST, port, tokens[0]):
+            pass
+        assert chat.connections_count == 4
+        await pool.close()
+        server.close()
+
+    asyncio.run(run())
+
+
+def test_checkout_waits_for_release_when_all_connections_are_busy():
+    async def run():
+        chat, server, tokens = await start_chat(2)
+        port = get_port(server)
+        pool = ConnectionPool(max_size=1)
+        second_checked_out = asyncio.Event()
+
+        async def check_out_second():
+            async with pool.session(HOST, port, tokens[1]):
+                second_checked_out.set()
+
+        async with pool.session(HOST, port, tokens[0]):
+            task = asyncio.create_task(check_out_second())
+            await asyncio.sleep(0.05)
+            assert not second_checked_out.is_set()
+
+        await task
+        assert pool.size == 1
+        await pool.close()
+        server.close()
+
+    asyncio.run(run())
+
+
+def test_connection_idle_longer_than_timeout_is_evicted():
+    async def run():
+        chat, server, [token] = await start_chat(1)
+        pool = ConnectionPool(idle_timeout=0.05)
+        async with pool.session(HOST, get_port(server), token):
+            pass
+
+        assert pool.evict_idle() == 0
+        time.sleep(0.1)
+        assert pool.evict_idle() == 1
+        assert pool.size == 0
+        server.close()
+
+    asyncio.run(run())
+
+
+def test_broken_idle_connection_is_replaced_on_checkout():
+    async def run():
+        chat, server, [token] = await start_chat(1)
+        pool = ConnectionPool()
+        async with pool.session(HOST, get_port(server), token) as first:
+            pass
+        chat.disconnect_all()
+        await asyncio.sleep(0.05)
+
+        async with pool.session(HOST, get_port(server), token) as second:
+            await chat_writer.submit_message(second.writer, 'after reconnect')
+            await chat_writer.read_reply(second.reader)
+
+        assert second is not first
+        assert pool.size == 1
+        assert chat.connections_count == 2
+        assert chat.received_count == 1
+        await pool.close()
+        server.close()
+
+    asyncio.run(run())
+
+
+def test_writer_daemon_clients_share_pooled_connection(tmp_path):
+    async def run():
+        chat, server, [token] = await start_chat(1)
+        daemon = WriterDaemon()
+        socket_path = tmp_path / 'daemon.sock'
+        daemon_server = await asyncio.start_unix_server(daemon.handle_client, socket_path)
+        options = chat_writer.Options(
+            host=HOST, port=get_port(server), message='', messages_path=None, token=token,
+            username='', credential_path=tmp_path / 'creds', logging=False,
+            daemon_socket_path=socket_path)
+
+        for messages in (['first', 'second'], ['third']):
+            submitted_count = await chat_writer.submit_via_daemon(
+                options, token, iter(messages))
+            assert submitted_count == len(messages)
+        await chat.wait_received(3)
+
+        assert chat.connections_count == 1
+        assert daemon.pool.idle_count == 1
+        daemon_server.close()
+        await daemon.pool.close()
+        server.close()
+
+    asyncio.run(run())
+
+
+async def submit_with_disconnect(chat, socket_path, token, port, is_token_revoked):
+    """Submit two messages by daemon and drop connection of chat between them"""
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    header = {'host': HOST, 'port': port, 'token': token}
+    writer.write(json.dumps(header).encode() + b'\n')
+    assert json.loads(await reader.readline()) == {'ok': True}
+
+    writer.write(json.dumps('first').encode() + b'\n')
+    await chat.wait_received(1)
+    # reply on the first message is read by daemon
+    await asyncio.sleep(0.05)
+    if is_token_revoked:
+        chat.tokens.clear()
+    chat.disconnect_all()
+    await asyncio.sleep(0.05)
+
+    writer.write(json.dumps('second').encode() + b'\n')
+    writer.write_eof()
+    answer = json.loads(await reader.readline())
+    writer.close()
+    return answer
+
+
+@pytest.mark.parametrize('is_token_revoked', [False, True])
+def test_writer_daemon_reports_messages_after_reconnect(tmp_path, monkeypatch,
+                                                        is_token_revoked):
+    monkeypatch.setattr(writer_daemon, 'ReconnectPolicy',
+                        lambda: ReconnectPolicy(base_delay=0.01))
+
+    async def run():
+        chat, server, [token] = await start_chat(1)
+        daemon = WriterDaemon()
+        socket_path = tmp_path / 'daemon.sock'
+        daemon_server = await asyncio.start_unix_server(daemon.handle_client, socket_path)
+        answer = await submit_with_disconnect(chat, socket_path, token, get_port(server),
+                                              is_token_revoked)
+
+        if is_token_revoked:
+            assert answer == {'submitted': 1, 'failed': 1}
+            assert chat.received_count == 1
+        else:
+            assert answer == {'submitted': 2, 'failed': 0}
+            assert chat.received_count == 2
+        daemon_server.close()
+        await daemon.pool.close()
+        server.close()
+
+    asyncio.run(run())
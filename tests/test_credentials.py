@@ -0,0 +1,30 @@
+from credentials import CredentialStore
+
+
+def make_creds(nickname):
+    return {'nickname': nickname, 'account_hash': f'{nickname}-token'}
+
+
+def test_lines_appended_between_refresh_and_write_are_indexed(tmp_path, monkeypatch):
+    path = tmp_path / 'creds'
+    index_path = tmp_path / 'creds.sqlite'
+    with CredentialStore(path, index_path) as store:
+        store.add(make_creds('first'))
+        refresh = store.refresh
+
+        def refresh_and_append_by_another_process():
+            count = refresh()
+            with CredentialStore(path) as other_store:
+                other_store.add(make_creds('other'))
+            return count
+
+        monkeypatch.setattr(store, 'refresh', refresh_and_append_by_another_process)
+        store.add(make_creds('mine'))
+        monkeypatch.undo()
+
+        assert store.get_token('mine') == 'mine-token'
+        assert store.get_token('other') == 'other-token'
+
+    with CredentialStore(path, index_path) as store:
+        assert store.get_token('other') == 'other-token'
+        assert store.get_token('mine') == 'mine-token'
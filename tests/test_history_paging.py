@@ -0,0 +1,121 @@
+import asyncio
+import logging
+
+import pytest
+
+from messenger import Messenger
+from messenger_gui import PanelLines
+from queues import BoundedQueue, OverflowPolicy
+from search import SearchIndex
+
+PAGE_SIZE = 10
+
+
+@pytest.fixture(autouse=True)
+def disable_logging():
+    logging.disable()
+    yield
+    logging.disable(logging.NOTSET)
+
+
+def create_messenger(history_path, messages_queue):
+    return Messenger(
+        messages_queue=messages_queue, sending_queue=BoundedQueue(10),
+        status_updates_queue=BoundedQueue(10, OverflowPolicy.DROP_OLDEST),
+        listen_host='127.0.0.1', listen_port=0, history_path=history_path,
+        write_host='127.0.0.1', write_port=0, token='', history_page_size=PAGE_SIZE)
+
+
+def save(history_path, lines):
+    with open(history_path, 'a', encoding='UTF8') as f:
+        f.writelines(f'{line}\n' for line in lines)
+
+
+def test_older_page_ends_before_the_oldest_shown_received_message(tmp_path):
+    async def run():
+        history_path = tmp_path / 'history.txt'
+        save(history_path, (f'old {number}' for number in range(30)))
+        # GUI queue drops the oldest message, it is saved but never shown
+        messages_queue = BoundedQueue(2, OverflowPolicy.DROP_OLDEST)
+        messenger = create_messenger(history_path, messages_queue)
+        panel_lines = PanelLines(messages_queue)
+
+        assert messenger.load_older_history_messages()[0] == 'old 20'
+        panel_lines.history_count += PAGE_SIZE
+
+        for number in range(1, 4):
+            messages_queue.put_nowait(f'new {number}')
+        save(history_path, (f'new {number}' for number in range(1, 4)))
+        while not messages_queue.empty():
+            messages_queue.get_nowait()
+        panel_lines.add_received(2)
+
+        # page of history and 'new 2' are not shown anymore
+        messenger.forget_history_messages(*panel_lines.evict(PAGE_SIZE + 1))
+
+        page = messenger.load_older_history_messages()
+        assert page[-1] == 'new 2'
+        assert page[0] == 'old 22'
+
+    asyncio.run(run())
+
+
+def test_older_page_waits_for_saving_of_forgotten_messages(tmp_path):
+    async def run():
+        history_path = tmp_path / 'history.txt'
+        save(history_path, (f'old {number}' for number in range(30)))
+        messages_queue = asyncio.Queue()
+        messenger = create_messenger(history_path, messages_queue)
+        panel_lines = PanelLines(messages_queue)
+        messenger.load_older_history_messages()
+        panel_lines.history_count += PAGE_SIZE
+
+        panel_lines.add_received(5)
+        save(history_path, ['new 1', 'new 2'])
+        messenger.forget_history_messages(*panel_lines.evict(PAGE_SIZE + 3))
+
+        # 'new 3' is still in buffer of history sink
+        assert messenger.load_older_history_messages() is None
+        save(history_path, ['new 3', 'new 4', 'new 5'])
+        page = messenger.load_older_history_messages()
+        assert page[-3:] == ['new 1', 'new 2', 'new 3']
+
+    asyncio.run(run())
+
+
+def test_search_result_is_found_by_id_among_repeated_texts(tmp_path):
+    async def run():
+        history_path = tmp_path / 'history.txt'
+        # ids of search index are numbers of lines in history
+        save(history_path, ('same' if number % 5 == 0 else f'old {number}'
+                            for number in range(1, 31)))
+        messages_queue = asyncio.Queue()
+        messenger = create_messenger(history_path, messages_queue)
+        panel_lines = PanelLines(messages_queue)
+        messenger.load_older_history_messages()
+        panel_lines.history_count += PAGE_SIZE
+
+        panel_lines.add_received(3)
+        save(history_path, ['same', 'new 2', 'same'])
+        search_index = SearchIndex(history_path)
+        while search_index.update():
+            pass
+        result_ids = [result.id for result in search_index.search('same')]
+        start_id = messenger.get_history_start_id()
+        assert start_id == 30
+
+        def find_ids(panel_ids):
+            lines = [panel_lines.find_line(result_id - start_id)
+                     for result_id in result_ids]
+            return [panel_ids[line - 1] for line in lines if line]
+
+        assert find_ids([*range(21, 31), 31, 32, 33]) == [25, 30, 31, 33]
+
+        # page of history and the first received message are not shown anymore
+        messenger.forget_history_messages(*panel_lines.evict(PAGE_SIZE + 1))
+        page = messenger.load_older_history_messages()
+        panel_lines.history_count += len(page)
+
+        assert find_ids([*range(22, 32), 32, 33]) == [25, 30, 31, 33]
+
+    asyncio.run(run())
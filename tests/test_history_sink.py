@@ -0,0 +1,25 @@
+import asyncio
+
+from history import HistorySink
+from queues import BoundedQueue
+
+
+async def run_sink(sink, items, queue_size=10):
+    queue = BoundedQueue(queue_size)
+    task = asyncio.create_task(sink.run(queue))
+    for item in items:
+        await queue.put(item)
+    await asyncio.sleep(0.05)
+    bound = sink.max_messages_lost_on_crash
+    task.cancel()
+    await asyncio.wait([task])
+    return bound
+
+
+def test_max_messages_lost_on_crash_counts_queue_and_batch(tmp_path):
+    sink = HistorySink(tmp_path / 'history.txt', flush_size=5)
+    assert sink.max_messages_lost_on_crash is None
+
+    assert asyncio.run(run_sink(sink, ['first', 'second'])) == 15
+    assert asyncio.run(run_sink(sink, [b'first\nsecond'])) is None
+    assert (tmp_path / 'history.txt').read_text(encoding='UTF8').count('\n') == 4
@@ -0,0 +1,46 @@
+import asyncio
+import json
+import logging
+from pathlib import Path
+
+import pytest
+
+from benchmark import bench_replay, compare_with_baseline, write_synthetic_capture
+
+# throughputs of replay of the synthetic capture, it is regenerated the same on every run.
+# Baseline is a conservative floor measured on developer machine, so slow runners pass it,
+# and only regression by several times fails the test
+BASELINE_PATH = Path(__file__).with_name('replay_baseline.json')
+LINES_COUNT = 20000
+TOLERANCE = 0.5
+
+
+@pytest.fixture(autouse=True)
+def disable_logging():
+    logging.disable()
+    yield
+    logging.disable(logging.NOTSET)
+
+
+def test_replay_throughput_is_not_lower_than_baseline(tmp_path):
+    capture_path = tmp_path / 'synthetic.cap'
+    write_synthetic_capture(capture_path, LINES_COUNT)
+
+    rates = asyncio.run(bench_replay(capture_path, speed=0))
+
+    with open(BASELINE_PATH, encoding='UTF8') as f:
+        baseline = json.load(f)
+    # names have digest and lines count of capture, so they differ if capture is changed
+    assert rates.keys() == baseline.keys()
+    assert compare_with_baseline(rates, BASELINE_PATH, TOLERANCE) == []
+
+
+def test_regression_is_reported(tmp_path):
+    baseline_path = tmp_path / 'baseline.json'
+    baseline_path.write_text(json.dumps({'replay messenger': 1000.0, 'listen': 1000.0}))
+
+    regressions = compare_with_baseline(
+        {'replay messenger': 700.0, 'listen': 900.0, 'new benchmark': 1.0}, baseline_path,
+        tolerance=0.2)
+
+    assert regressions == ['replay messenger: 700/sec, baseline 1,000']
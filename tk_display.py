@@ -0,0 +1,33 @@
+import asyncio
+import _tkinter
+import tkinter as tk
+
+
+class TkAppClosed(Exception):
+    pass
+
+
+async def update_tk(root_frame, interval=1 / 120, idle_interval=1 / 20):
+    """
+    Process all pending Tk events every interval seconds while there are any events.
+
+    When application is idle, the interval doubles up to idle_interval and
+    returns back to interval on the first event. Tk has no portable descriptor
+    to wait for its events, so they are polled
+    """
+    current_interval = interval
+    while True:
+        try:
+            has_events = root_frame.tk.dooneevent(_tkinter.DONT_WAIT)
+            # events which are already queued by Tk or Xlib are processed too,
+            # so nothing waits for the next poll
+            root_frame.update()
+        except tk.TclError:
+            # if application has been destroyed/closed
+            raise TkAppClosed()
+
+        if has_events:
+            current_interval = interval
+        else:
+            current_interval = min(current_interval * 2, idle_interval)
+        await asyncio.sleep(current_interval)
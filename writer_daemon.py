@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+import json
+import logging
+import os
+from pathlib import Path
+import signal
+from typing import Optional
+
+from authorized_connection import (
+    AuthorizedConnection, ConnectionKey, ConnectionPool, InvalidTokenError)
+from chat_writer import get_daemon_socket_path, read_reply, submit_message
+from reconnect import ReconnectPolicy
+
+logger = logging.getLogger(__name__)
+
+# count of messages between confirmations to client
+CONFIRMATION_INTERVAL = 100
+
+
+@dataclass
+class Options:
+    socket_path: Optional[Path]
+    idle_timeout: float
+    logging: bool
+    max_connections: int = 100
+
+
+class WriterSession:
+    """
+    Submission of queued messages of one client by connection checked out of pool.
+
+    Messages are pipelined, session waits for the socket only when queue is empty.
+    Message is submitted when reply of chat on it is read. Lost connection is checked
+    out again with growing delay and unconfirmed messages are written again, so
+    message whose reply was lost can be duplicated. When None is queued and every
+    reply is read, connection returns in pool, so the next client with the same
+    token reuses it
+    """
+
+    def __init__(self, pool: ConnectionPool, key: ConnectionKey):
+        self.pool = pool
+        self.key = key
+        self.messages = asyncio.Queue()
+        # result is set after the first authorization, client waits for it before queueing
+        self.authorized = asyncio.get_running_loop().create_future()
+        self.task: Optional[asyncio.Task] = None
+        self.submitted_count = 0
+        self.reconnect_policy = ReconnectPolicy()
+        # messages which are written but whose replies aren't read, chat replies in order
+        self._unconfirmed = deque()
+        self._is_all_queued = False
+
+    def __str__(self):
+        host, port, _ = self.key
+        return f'{host}:{port}'
+
+    async def run(self) -> None:
+        while True:
+            self.reconnect_policy.attempt()
+            try:
+                # connection is closed by pool if it is lost while submitting
+                async with self.pool.session(*self.key) as connection:
+                    # idle connection without replies is proved by time of connection
+                    self.reconnect_policy.record_connected()
+                    if not self.authorized.done():
+                        self.authorized.set_result(connection.creds)
+                    await self._submit(connection)
+                    return
+            except (InvalidTokenError, OSError) as e:
+                if not self.authorized.done():
+                    self.authorized.set_exception(e)
+                    return
+                if isinstance(e, InvalidTokenError):
+                    # client counts the rest of its messages as failed
+                    logger.error('%s: token is not valid anymore, %d written messages '
+                                 'are not submitted', self, len(self._unconfirmed))
+                    return
+                logger.warning('%s: connection error %r', self, e)
+
+            delay = self.reconnect_policy.next_delay()
+            logger.warning('%s: reconnect in %.1fs', self, delay)
+            await asyncio.sleep(delay)
+
+    async def _submit(self, connection: AuthorizedConnection) -> None:
+        """Submit queued messages until all are replied, raise ConnectionError if lost"""
+        replies_task = asyncio.create_task(self._read_replies(connection.reader))
+        try:
+            # it is unknown whether chat got them before the previous connection was lost
+            for message in list(self._unconfirmed):
+                await submit_message(connection.writer, message, drain=False)
+
+            while not self._is_all_queued:
+                message = await self._next_message(connection)
+                if message is None:
+                    self._is_all_queued = True
+                    break
+                # message is written again after reconnect if it is lost here
+                self._unconfirmed.append(message)
+                if replies_task.done():
+                    # replies task ends before all are queued only by exception
+                    replies_task.result()
+                await submit_message(connection.writer, message, drain=False)
+
+            await connection.writer.drain()
+            if self._unconfirmed:
+                # connection returns in pool without unread replies
+                await replies_task
+        finally:
+            replies_task.cancel()
+
+    async def _read_replies(self, reader: asyncio.StreamReader) -> None:
+        """Confirm written messages by replies of chat until all are confirmed"""
+        while True:
+            await read_reply(reader)
+            self.reconnect_policy.record_success()
+            if self._unconfirmed:
+                self._unconfirmed.popleft()
+                self.submitted_count += 1
+            if self._is_all_queued and not self._unconfirmed:
+                return
+
+    async def _next_message(self, connection: AuthorizedConnection) -> Optional[str]:
+        """Return the next message or None when client has no more messages"""
+        if not self.messages.empty():
+            return self.messages.get_nowait()
+
+        # nothing to pipeline anymore, so everything written is pushed to the socket
+        await connection.writer.drain()
+        return await self.messages.get()
+
+
+class WriterDaemon:
+    """
+    Local server which holds pool of authorized connections for chat_writer invocations.
+
+    Client sends json header line with host, port and token, daemon answers
+    json line with ok or error after authorization of session. Then client sends
+    json string of message per line and closes writing. Daemon answers with count
+    of submitted messages every CONFIRMATION_INTERVAL submitted messages and with
+    counts of submitted and failed messages after the last one, message is submitted
+    when chat replied on it. Messages are submitted by connection checked out of pool,
+    it returns in pool after the client and is closed after idle_timeout seconds
+    without clients
+    """
+
+    def __init__(self, idle_timeout: float = 60.0, max_connections: int = 100):
+        self.pool = ConnectionPool(max_connections, idle_timeout)
+
+    async def handle_client(self, reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter) -> None:
+        try:
+            header = json.loads(await reader.readline())
+            key = (header['host'], int(header['port']), header['token'])
+            session = WriterSession(self.pool, key)
+            session.task = asyncio.create_task(session.run())
+            try:
+                await self._handle_messages(session, reader, writer)
+            finally:
+                # queued messages are submitted even if client is disconnected
+                await self._wait_session(session)
+                self._log_session(session)
+        except (ValueError, KeyError, TypeError) as e:
+            await self._answer(writer, {'error': f'bad request {e!r}'})
+        except ConnectionError:
+            logger.debug('client is disconnected')
+        finally:
+            writer.close()
+
+    async def _handle_messages(self, session: WriterSession, reader: asyncio.StreamReader,
+                               writer: asyncio.StreamWriter) -> None:
+        try:
+            await asyncio.shield(session.authorized)
+        except InvalidTokenError:
+            await self._answer(writer, {'error': 'wrong token'})
+            return
+        except OSError as e:
+            await self._answer(writer, {'error': f'chat is not available {e!r}'})
+            return
+        await self._answer(writer, {'ok': True})
+
+        queued_count = 0
+        confirmed_count = 0
+        async for line in reader:
+            session.messages.put_nowait(json.loads(line))
+            queued_count += 1
+            if session.submitted_count - confirmed_count >= CONFIRMATION_INTERVAL:
+                # client knows how many messages are submitted if daemon is lost
+                confirmed_count = session.submitted_count
+                await self._answer(writer, {'submitted': confirmed_count})
+        await self._wait_session(session)
+        # messages are left unsubmitted when token is rejected after reconnect
+        await self._answer(writer, {'submitted': session.submitted_count,
+                                    'failed': queued_count - session.submitted_count})
+
+    @staticmethod
+    async def _wait_session(session: WriterSession) -> None:
+        """Wait until all queued messages are submitted, it is done once"""
+        if not session.task.done():
+            session.messages.put_nowait(None)
+        # daemon can be stopped while client waits, session is cancelled with daemon
+        await asyncio.wait([session.task])
+
+    @staticmethod
+    def _log_session(session: WriterSession) -> None:
+        if not session.task.cancelled() and session.task.exception() is not None:
+            logger.error('%s: session failed %r', session, session.task.exception())
+        logger.info('%s: session is closed, %d messages submitted', session,
+                    session.submitted_count)
+
+    @staticmethod
+    async def _answer(writer: asyncio.StreamWriter, answer: dict) -> None:
+        writer.write(json.dumps(answer).encode() + b'\n')
+        await writer.drain()
+
+
+async def serve(options: Options) -> None:
+    daemon = WriterDaemon(options.idle_timeout, options.max_connections)
+    socket_path = options.socket_path or get_daemon_socket_path()
+    # file of previous daemon stays after kill, it would break binding
+    socket_path.unlink(missing_ok=True)
+    # session of any token can be used by everyone who can connect to socket,
+    # so socket is created without access of others, not changed after binding
+    previous_umask = os.umask(0o177)
+    try:
+        server = await asyncio.start_unix_server(daemon.handle_client, socket_path)
+    finally:
+        os.umask(previous_umask)
+    logger.info('listen on %s', socket_path)
+
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    eviction_task = asyncio.create_task(daemon.pool.run_eviction())
+    try:
+        async with server:
+            await server.serve_forever()
+    except asyncio.CancelledError:
+        logger.info('stopped')
+    finally:
+        socket_path.unlink(missing_ok=True)
+        eviction_task.cancel()
+        await daemon.pool.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    parser = argparse.ArgumentParser(
+        prog='Chat writer daemon',
+        description='Local daemon which holds authorized chat sessions for chat writer',
+    )
+
+    parser.add_argument('-s', '--socket_path', type=Path, default=None,
+                        help='path of unix socket to listen, '
+                             'in runtime directory of user by default')
+    parser.add_argument('-it', '--idle_timeout', type=float, default=60.0,
+                        help='seconds without clients before connection is closed')
+    parser.add_argument('-mc', '--max_connections', type=int, default=100,
+                        help='max count of connections to chat, '
+                             'clients wait for free one if all are busy')
+    parser.add_argument('-l', '--logging', action='store_true', default=False,
+                        help='is do logging')
+
+    args = parser.parse_args()
+
+    options = Options(**args.__dict__)
+
+    if not options.logging:
+        logging.disable()
+
+    try:
+        asyncio.run(serve(options))
+    except KeyboardInterrupt:
+        pass